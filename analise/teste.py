@@ -414,19 +414,18 @@ def expandir_cotas(df, colateral=0.4, apys_df=None, compounded=False, tx_adm_cir
 
                 base_valor_colateral = valor_colateral if (not compounded or first_month) else rentabilidade_colateral
                 rentabilidade_colateral = calcular_rentabilidade_mes(valor=base_valor_colateral, data=month, apys_df=apys_df)
-                profits_colateral_dolar += rentabilidade_colateral - valor_colateral
+                profits_colateral_dolar += rentabilidade_colateral - base_valor_colateral
 
                 base_valor_bem = bem_contemplacao_dolar if (not compounded or first_month) else rentabilidade_colateral_bem
                 rentabilidade_colateral_bem = calcular_rentabilidade_mes(valor=base_valor_bem, data=month, apys_df=apys_df)
-                profits_bem_dolar += rentabilidade_colateral_bem - bem_contemplacao_dolar
+                profits_bem_dolar += rentabilidade_colateral_bem - base_valor_bem
 
                 rentabilidade_colateral_real = convert_currency(date=month, amount=rentabilidade_colateral, to_currency='brl')
                 rentabilidade_bem_contemplacao_real = convert_currency(date=month, amount=rentabilidade_colateral_bem, to_currency='brl')
                 profits_bem = convert_currency(date=month, amount=profits_bem_dolar, to_currency='brl')
                 profits_colateral = convert_currency(date=month, amount=profits_colateral_dolar, to_currency='brl')
                 bem_contemplacao_dolar_show = convert_currency(date=month, amount=bem_contemplacao_dolar+profits_bem_dolar, to_currency='brl')
-                if not first_month:
-                    first_month = False
+                first_month = False
 
             common_values = {
                 "id": cota_id,
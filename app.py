@@ -1,10 +1,11 @@
 import streamlit as st
-import os
-import pandas as pd
-import matplotlib.pyplot as plt
-from load_functions import path_dict_to_df, load_and_preprocess_grupo,fetch_file_from_google_drive, get_folder_id, drive_service
-from cotas_processor import expandir_cotas
-from graphics import compare_consorcio_circulana, plot_quota_comparison
+import instrumentation
+from load_functions import load_and_preprocess_grupo, APY_FILES, GROUP_FILE
+from artifacts import ExpandedScenario, QuotaIndex, read_expanded_scenario
+from cost_cube import COST_CUBE_SOURCE_COLUMNS, build_cost_cube
+from grupo_filters import MonthFilterIndex
+from scenario_cache import COLLATERAL_STEP, scenario_artifact
+from graphics import add_quota_summary_columns, compare_consorcio_circulana, plot_quota_comparison
 
 # =====================================================
 # 1. Configurações gerais do app
@@ -17,39 +18,72 @@ st.sidebar.title("Parâmetros")
 st.sidebar.header("Circulana")
 
 with st.sidebar.expander("Filtros", expanded=True):
-    place_of_interest = st.selectbox("Select Place of Interest", ['aave', 'compound', 'uniswap', 'balancer'], index=0)
-    collateral_percentage = st.slider("Collateral Percentage", 0.0, 1.0, 0.4)
+    # Every combination is precomputed by precompute.py, so changing them never expands in-request.
+    place_of_interest = st.selectbox("Select Place of Interest", list(APY_FILES), index=0)
+    collateral_percentage = st.slider("Collateral Percentage", 0.0, 1.0, 0.4, step=COLLATERAL_STEP)
+
+# Each session has its own timings flag and stats; the process-wide ones are left to scripts.
+if 'timings' not in st.session_state:
+    st.session_state.timings = instrumentation.Session(enabled=instrumentation.is_enabled())
+instrumentation.use_session(st.session_state.timings)
+
+performance_panel = st.sidebar.expander("Performance", expanded=False)
+with performance_panel:
+    if st.checkbox("Collect timings", value=instrumentation.is_enabled()):
+        instrumentation.enable()
+    else:
+        instrumentation.disable()
+    if st.button("Reset timings"):
+        instrumentation.reset()
 
 @st.cache_data
-def load_data(place_of_interest):
-    if collateral_percentage == 0.4 and place_of_interest == "aave":
-        file_path_consorcio = 'df_expanded_consorcio.pkl'
-        file_path_circulana = 'df_expanded_circulana.pkl'
-        if not os.path.exists(file_path_consorcio):
-            folder_id = get_folder_id(drive_service, "Base_simulacao")
-            fetch_file_from_google_drive(drive_service, file_path_consorcio, file_path_consorcio, folder_id=folder_id)
-        df_expanded_consorcio = pd.read_pickle('df_expanded_consorcio.pkl')
-        if not os.path.exists(file_path_circulana):
-            folder_id = get_folder_id(drive_service, "Base_simulacao")
-            fetch_file_from_google_drive(drive_service, file_path_circulana, file_path_circulana, folder_id=folder_id)
-        df_expanded_circulana = pd.read_pickle('df_expanded_circulana.pkl')
-        df_grupo = load_and_preprocess_grupo('santander_cotas_pre_grupo_md_cota655_202502211443.csv')
-    else:
-        apys_df = path_dict_to_df(place_of_interest)
-        df_grupo = load_and_preprocess_grupo('santander_cotas_pre_grupo_md_cota655_202502211443.csv')
-        df_expanded_consorcio, df_expanded_circulana = expandir_cotas(
-            df_grupo, apys_df=apys_df, tx_adm_circulana=None
-        )
-    return df_expanded_consorcio, df_expanded_circulana, df_grupo
+def load_data():
+    df_grupo = load_and_preprocess_grupo(GROUP_FILE)
+    return df_grupo, QuotaIndex.from_frame(df_grupo), MonthFilterIndex(df_grupo)
+
+# Scenarios are kept once per process in compact form (see artifacts.ExpandedScenario) and the
+# frames are rebuilt from them on each run, instead of st.cache_data holding a pickled copy.
+# Per-quota frames are sliced through the scenario's quota index, never by scanning the ids,
+# and already carry the costs and amounts received of the quota comparison.
+@st.cache_resource(max_entries=16)
+def load_scenario(artifact_path):
+    scenario = read_expanded_scenario(artifact_path)
+    return ExpandedScenario(*add_quota_summary_columns(scenario.frame('consorcio'), scenario.frame('circulana')))
+
+def serve_scenario(place_of_interest, collateral_percentage):
+    """Artifact path and loaded scenario of the selected parameters."""
+    artifact_path = scenario_artifact(place_of_interest, collateral=collateral_percentage)
+    try:
+        return artifact_path, load_scenario(artifact_path)
+    except FileNotFoundError:
+        # Only pinned scenarios are kept for sure; another session or a precompute run may have
+        # evicted this one since it was resolved. Resolving it again recomputes it.
+        artifact_path = scenario_artifact(place_of_interest, collateral=collateral_percentage)
+        return artifact_path, load_scenario(artifact_path)
+
+# The group overview reads the cost cube of the scenario, built once from the expanded rows.
+# The group is an input of the scenario, so the artifact path identifies it too.
+@st.cache_data(max_entries=16)
+def load_cost_cube(artifact_path, _df_grupo):
+    scenario = load_scenario(artifact_path)
+    return build_cost_cube(
+        scenario.frame('consorcio', columns=COST_CUBE_SOURCE_COLUMNS['consorcio']),
+        scenario.frame('circulana', columns=COST_CUBE_SOURCE_COLUMNS['circulana']),
+        _df_grupo,
+    )
 
 # Load data
-df_expanded_consorcio, df_expanded_circulana, df_grupo = load_data(place_of_interest)
+df_grupo, grupo_index, filter_index = load_data()
+# The artifact path is resolved on every run, never cached: the scenario cache may evict the
+# artifact since, and resolving recomputes it. A cache hit only touches the cache index.
+artifact_path, scenario = serve_scenario(place_of_interest, collateral_percentage)
+cost_cube = load_cost_cube(artifact_path, df_grupo)
 
 # Default quotas to display
 selected_quotas = [30506940, 30438293]
-filtered_grupo = df_grupo[df_grupo['id'].isin(selected_quotas)]
-filtered_consorcio = df_expanded_consorcio[df_expanded_consorcio['id'].isin(selected_quotas)]
-filtered_circulana = df_expanded_circulana[df_expanded_circulana['id'].isin(selected_quotas)]
+filtered_grupo = grupo_index.take(df_grupo, selected_quotas)
+filtered_consorcio = scenario.frame('consorcio', ids=selected_quotas)
+filtered_circulana = scenario.frame('circulana', ids=selected_quotas)
 
 # Toggle for advanced filters
 show_advanced_filters = st.sidebar.checkbox("Show Advanced Filters")
@@ -59,32 +93,23 @@ if show_advanced_filters:
     tx_adm_options = ["All"] + sorted(df_grupo['TX_adm_%'].unique().tolist())
     tx_adm_filter = st.sidebar.selectbox("Select TX Adm %", tx_adm_options, index=None)
 
-    creation_months = ["All"] + sorted(pd.to_datetime(df_grupo['dt_venda'], errors='coerce').dropna().dt.to_period('M').astype(str).unique().tolist())
-    cancellation_months = ["All"] + sorted(pd.to_datetime(df_grupo['dt_canc'], errors='coerce').dropna().dt.to_period('M').astype(str).unique().tolist())
-    contemplation_months = ["All"] + sorted(pd.to_datetime(df_grupo['dt_contemplacao'], errors='coerce').dropna().dt.to_period('M').astype(str).unique().tolist())
+    creation_months = ["All"] + filter_index.months('dt_venda')
+    cancellation_months = ["All"] + filter_index.months('dt_canc')
+    contemplation_months = ["All"] + filter_index.months('dt_contemplacao')
 
     selected_creation_month = st.sidebar.selectbox("Filter by Creation Month (dt_venda)", creation_months)
     selected_cancellation_month = st.sidebar.selectbox("Filter by Cancellation Month (dt_canc)", cancellation_months)
     selected_contemplation_month = st.sidebar.selectbox("Filter by Contemplation Month (dt_contemplacao)", contemplation_months)
 
     def filter_data(df, creation_month, cancellation_month, contemplation_month):
-        df['dt_venda'] = pd.to_datetime(df['dt_venda'], errors='coerce')
-        df['dt_canc'] = pd.to_datetime(df['dt_canc'], errors='coerce')
-        df['dt_contemplacao'] = pd.to_datetime(df['dt_contemplacao'], errors='coerce')
-
-        if creation_month != "All":
-            df = df[df['dt_venda'].dt.to_period('M').astype(str) == creation_month]
-        if cancellation_month != "All":
-            df = df[df['dt_canc'].dt.to_period('M').astype(str) == cancellation_month]
-        if contemplation_month != "All":
-            df = df[df['dt_contemplacao'].dt.to_period('M').astype(str) == contemplation_month]
-        
-        return df
+        # The month indexes give the matching ids; df is only sliced, never modified.
+        ids = filter_index.ids(dt_venda=creation_month, dt_canc=cancellation_month, dt_contemplacao=contemplation_month)
+        return grupo_index.take(df, ids)
 
     # Apply filters
     filtered_grupo = filter_data(df_grupo, selected_creation_month, selected_cancellation_month, selected_contemplation_month)
-    filtered_consorcio = df_expanded_consorcio[df_expanded_consorcio['id'].isin(filtered_grupo['id'])]
-    filtered_circulana = df_expanded_circulana[df_expanded_circulana['id'].isin(filtered_grupo['id'])]
+    filtered_consorcio = scenario.frame('consorcio', ids=filtered_grupo['id'].to_numpy())
+    filtered_circulana = scenario.frame('circulana', ids=filtered_grupo['id'].to_numpy())
 
     # Allow user to select one quota for more detailed analysis
     options = [q for q in filtered_grupo['id'].unique() if q != 254307]
@@ -92,7 +117,7 @@ if show_advanced_filters:
 
     if quota_id:
         st.write(f"### Detailed View of Quota {quota_id}")
-        plot_quota_comparison(df_expanded_consorcio, df_expanded_circulana, quota_id)
+        plot_quota_comparison(scenario.frame('consorcio', ids=[quota_id]), scenario.frame('circulana', ids=[quota_id]), quota_id, cache_key=artifact_path)
 
 # Display Quota Details
 st.title("Consórcio x Circulana")
@@ -103,17 +128,25 @@ st.write("""
 # Compare costs
 st.header("Análise da Cota")
 
+filtered_index = QuotaIndex.from_frame(filtered_consorcio)
 for quota_id in selected_quotas:
-    with st.expander(f"Cenário: Cota {quota_id} (Taxa adm: {df_grupo[df_grupo['id']==quota_id]['TX_adm_%'].iloc[0]}%, Crédito inicial: R${df_grupo[df_grupo['id']==quota_id]['vl_bem'].iloc[0]})", expanded=False):
-        plot_quota_comparison(filtered_consorcio, filtered_circulana, quota_id)
+    quota_info = df_grupo.iloc[grupo_index.slice(quota_id)].iloc[0]
+    with st.expander(f"Cenário: Cota {quota_id} (Taxa adm: {quota_info['TX_adm_%']}%, Crédito inicial: R${quota_info['vl_bem']})", expanded=False):
+        plot_quota_comparison(filtered_consorcio, filtered_circulana, quota_id, index=filtered_index, cache_key=artifact_path)
 
 st.header("Análise do Grupo")
 with st.expander("Visão geral", expanded=False):
     st.write("### Valor Total Pago")
     compare_consorcio_circulana(
-    df_expanded_consorcio, df_expanded_circulana,
-    tx_adm_filter=None if not show_advanced_filters else tx_adm_filter,
+    cost_cube,
+    tx_adm_filter=tx_adm_filter if show_advanced_filters and tx_adm_filter != "All" else None,
     month_contemplated=selected_contemplation_month if show_advanced_filters and selected_contemplation_month != "All" else None,
     month_canceled=selected_cancellation_month if show_advanced_filters and selected_cancellation_month != "All" else None
 )
-    st.write(filtered_consorcio)
\ No newline at end of file
+    st.write(filtered_consorcio)
+
+# Timings of this session's runs; cached steps only show up on the run that computed them.
+with performance_panel:
+    if instrumentation.is_enabled():
+        st.dataframe(instrumentation.report(), hide_index=True)
+        st.download_button("Export JSON", instrumentation.export_json(), file_name="timings.json", mime="application/json")
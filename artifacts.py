@@ -0,0 +1,333 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from instrumentation import instrumented
+
+# Bump whenever the columns or the layout of the expanded frames change, so stale
+# artifacts are rebuilt instead of being read with the wrong schema.
+SCHEMA_VERSION = 1
+ID_BUCKET_SIZE = 50_000
+COMPRESSION = 'zstd'
+PRODUCTS = ('consorcio', 'circulana')
+MANIFEST_FILE = 'artifact.json'
+# Largest error accepted when a column is held in float32: half a cent for money columns.
+MONEY_TOLERANCE = 0.005
+RATIO_TOLERANCE = 1e-6
+
+_local_fs = fs.LocalFileSystem(use_mmap=True)
+
+
+class ArtifactVersionError(ValueError):
+    """Raised when an artifact on disk was written with another schema version."""
+
+
+class ExpandedArtifactWriter:
+    """
+    Writes the expanded consorcio/circulana frames as Parquet datasets partitioned by quota id range.
+
+    Layout:
+    path/artifact.json                                   schema version, bucket size, row count
+    path/<product>/id_bucket=<id // bucket size>/part-<n>.parquet
+
+    Frames can be written in several chunks (e.g. from iter_expandir_cotas); the manifest
+    is only written on close, so a partially written artifact is never picked up as complete.
+    """
+
+    def __init__(self, path, id_bucket_size=ID_BUCKET_SIZE, compression=COMPRESSION):
+        self.path = path
+        self.id_bucket_size = id_bucket_size
+        self.compression = compression
+        self.n_rows = 0
+        self._part = 0
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        for product in PRODUCTS:
+            os.makedirs(os.path.join(path, product))
+
+    @instrumented('artifact.write')
+    def write(self, df_consorcio, df_circulana):
+        """Appends one chunk of both frames."""
+        if df_consorcio.empty:
+            return
+        for product, df_product in (('consorcio', df_consorcio), ('circulana', df_circulana)):
+            buckets = df_product['id'].to_numpy() // self.id_bucket_size
+            for bucket, df_bucket in df_product.groupby(buckets, sort=True):
+                directory = os.path.join(self.path, product, f'id_bucket={bucket:09d}')
+                os.makedirs(directory, exist_ok=True)
+                table = pa.Table.from_pandas(df_bucket, preserve_index=False)
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'schema_version': str(SCHEMA_VERSION).encode()})
+                pq.write_table(table, os.path.join(directory, f'part-{self._part:05d}.parquet'), compression=self.compression)
+        self._part += 1
+        self.n_rows += len(df_consorcio)
+
+    def close(self):
+        manifest = {
+            'schema_version': SCHEMA_VERSION,
+            'id_bucket_size': self.id_bucket_size,
+            'compression': self.compression,
+            'rows': self.n_rows,
+            'created_at': pd.Timestamp.now().isoformat(),
+        }
+        with open(os.path.join(self.path, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+def write_expanded_artifact(path, df_expanded_consorcio, df_expanded_circulana, id_bucket_size=ID_BUCKET_SIZE):
+    """Writes both expanded frames to path in the artifact format, replacing whatever was there."""
+    writer = ExpandedArtifactWriter(path, id_bucket_size=id_bucket_size)
+    writer.write(df_expanded_consorcio, df_expanded_circulana)
+    writer.close()
+
+
+def read_manifest(path):
+    """Returns the manifest of the artifact at path, or None if there is no complete artifact."""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def artifact_exists(path):
+    """Whether a complete artifact with the current schema version exists at path."""
+    manifest = read_manifest(path)
+    return manifest is not None and manifest.get('schema_version') == SCHEMA_VERSION
+
+
+@instrumented('artifact.read', rows=len)
+def read_expanded(path, product, columns=None, ids=None, months=None):
+    """
+    Reads one expanded frame from the artifact at path.
+
+    Files are memory-mapped and only the requested columns are decoded. Filters on ids and
+    months are pushed down: partitions outside the requested id ranges are skipped and row
+    groups are pruned from their statistics.
+
+    Parameters:
+    path (str): Artifact directory.
+    product (str): 'consorcio' or 'circulana'.
+    columns (list): Columns to read (default: all).
+    ids (list): Quota ids to read (default: all).
+    months (tuple): (first, last) months to read, inclusive; either can be None.
+
+    Returns:
+    pd.DataFrame: The rows sorted by id and month.
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError(f"No expanded artifact found at '{path}'.")
+    if manifest.get('schema_version') != SCHEMA_VERSION:
+        raise ArtifactVersionError(f"Artifact at '{path}' has schema version {manifest.get('schema_version')}, expected {SCHEMA_VERSION}.")
+    if product not in PRODUCTS:
+        raise ValueError("Invalid product. Use 'consorcio' or 'circulana'.")
+
+    dataset = ds.dataset(os.path.join(path, product), format='parquet', partitioning='hive', filesystem=_local_fs)
+    expression = None
+    if ids is not None:
+        ids = [int(quota_id) for quota_id in ids]
+        buckets = sorted({quota_id // manifest['id_bucket_size'] for quota_id in ids})
+        expression = ds.field('id_bucket').isin(buckets) & ds.field('id').isin(ids)
+    if months is not None:
+        first, last = months
+        if first is not None:
+            condition = ds.field('month') >= pd.Timestamp(first)
+            expression = condition if expression is None else expression & condition
+        if last is not None:
+            condition = ds.field('month') <= pd.Timestamp(last)
+            expression = condition if expression is None else expression & condition
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != 'id_bucket']
+    df = dataset.to_table(columns=list(columns), filter=expression).to_pandas()
+    if {'id', 'month'} <= set(df.columns) and not df['id'].is_monotonic_increasing:
+        df = df.sort_values(['id', 'month'], kind='stable').reset_index(drop=True)
+    return df
+
+
+def _smallest_int_dtype(values):
+    if not len(values):
+        return values.dtype
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return values.dtype
+
+
+def compact_array(name, values):
+    """
+    Returns values in the smallest dtype that represents them within tolerance, and the encoding used.
+
+    Integers take the smallest integer type holding their range, floats are held in float32
+    when that changes no value by more than MONEY_TOLERANCE (RATIO_TOLERANCE for '%' columns)
+    and dates on month starts become integer month codes.
+    """
+    if values.dtype.kind in 'iu':
+        return values.astype(_smallest_int_dtype(values), copy=False), 'plain'
+    if values.dtype.kind == 'f':
+        tolerance = RATIO_TOLERANCE if '%' in name else MONEY_TOLERANCE
+        with np.errstate(over='ignore', invalid='ignore'):
+            compact = values.astype(np.float32)
+            error = np.abs(compact.astype(np.float64) - values)
+        finite = np.isfinite(values)
+        if np.array_equal(finite, np.isfinite(compact)) and (not finite.any() or error[finite].max() <= tolerance):
+            return compact, 'plain'
+        return values, 'plain'
+    if values.dtype.kind == 'M':
+        codes = values.astype('datetime64[M]')
+        if np.array_equal(codes.astype(values.dtype), values):
+            codes = codes.astype(np.int64)
+            return codes.astype(_smallest_int_dtype(codes)), 'month'
+    return values, 'plain'
+
+
+class QuotaIndex:
+    """
+    Row range of each quota in a frame sorted by id.
+
+    Built once per frame, it turns per-quota selections into slices: selecting a quota costs
+    the rows of that quota instead of a comparison over the whole frame.
+    """
+
+    def __init__(self, ids):
+        ids = np.asarray(ids)
+        if len(ids) > 1 and (ids[1:] < ids[:-1]).any():
+            raise ValueError("QuotaIndex needs rows sorted by id.")
+        self.starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.zeros(0, dtype=np.int64)
+        self.stops = np.r_[self.starts[1:], len(ids)].astype(np.int64)
+        self.ids = ids[self.starts]
+        self.n_rows = len(ids)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(df['id'].to_numpy())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, quota_id):
+        return bool(self._lookup([quota_id])[1][0])
+
+    def _lookup(self, ids):
+        ids = np.asarray(ids, dtype=self.ids.dtype if len(self.ids) else np.int64)
+        position = np.minimum(np.searchsorted(self.ids, ids), max(len(self.ids) - 1, 0))
+        found = (self.ids[position] == ids) if len(self.ids) else np.zeros(len(ids), dtype=bool)
+        return position, found
+
+    def slice(self, quota_id):
+        """Rows of one quota, as a slice; raises KeyError when the id is not in the frame."""
+        position, found = self._lookup([quota_id])
+        if not found[0]:
+            raise KeyError(quota_id)
+        return slice(int(self.starts[position[0]]), int(self.stops[position[0]]))
+
+    def positions(self, ids):
+        """Row positions of the given quotas, in the order of ids; ids not in the frame are skipped."""
+        position, found = self._lookup(ids)
+        position = position[found]
+        lengths = self.stops[position] - self.starts[position]
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(self.starts[position] - offsets, lengths) + np.arange(int(lengths.sum()))
+
+    def take(self, df, ids):
+        """Rows of df for the given quotas, in the order of ids."""
+        return df.iloc[self.positions(ids)]
+
+
+class ExpandedScenario:
+    """
+    Both expanded frames of a scenario held in compact form.
+
+    Each distinct column is stored once: columns equal in both frames (id, month, vl_bem, ...)
+    and columns duplicated inside a frame (FC_paid/FC_paid_monthly, ...) share their storage,
+    columns constant within each quota (contracted_period, TX_adm_%, ...) are stored once per
+    quota, and every column is compacted with compact_array. Frames are rebuilt on demand with
+    their original dtypes by frame().
+    """
+
+    def __init__(self, df_consorcio, df_circulana):
+        if len(df_consorcio) != len(df_circulana) or not df_consorcio['id'].equals(df_circulana['id']):
+            raise ValueError("The consorcio and circulana frames must have the same quotas and rows.")
+        self.index = QuotaIndex.from_frame(df_consorcio)
+        self.n_rows = self.index.n_rows
+        starts = self.index.starts
+        run_lengths = self.index.stops - starts
+        run = np.repeat(np.arange(len(starts)), run_lengths)
+        self._run = run.astype(_smallest_int_dtype(run))
+        self._columns = {}
+        self._layout = {}
+        originals = []
+        for product, df in (('consorcio', df_consorcio), ('circulana', df_circulana)):
+            self._layout[product] = {}
+            for name in df.columns:
+                values = df[name].to_numpy()
+                key = next((key for key, other in originals if other.dtype == values.dtype and np.array_equal(other, values, equal_nan=values.dtype.kind == 'f')), None)
+                if key is None:
+                    key = f'{product}.{name}'
+                    originals.append((key, values))
+                    per_quota = values[starts]
+                    level = 'quota' if np.array_equal(np.repeat(per_quota, run_lengths), values, equal_nan=values.dtype.kind == 'f') else 'row'
+                    stored, encoding = compact_array(name, per_quota if level == 'quota' else values)
+                    self._columns[key] = (stored, level, values.dtype, encoding)
+                self._layout[product][name] = key
+
+    def columns(self, product):
+        return list(self._layout[product])
+
+    def frame(self, product, columns=None, ids=None):
+        """
+        Rebuilds one expanded frame, or the rows of some quotas only.
+
+        Parameters:
+        product (str): 'consorcio' or 'circulana'.
+        columns (list): Columns to rebuild (default: all).
+        ids (list): Quotas to rebuild, found through the quota index (default: all).
+
+        Returns:
+        pd.DataFrame: The frame sorted by id, with its original column order and dtypes.
+        """
+        if product not in self._layout:
+            raise ValueError("Invalid product. Use 'consorcio' or 'circulana'.")
+        rows = None if ids is None else self.index.positions(np.unique(np.asarray(ids, dtype=np.int64)))
+        run = self._run if rows is None else self._run[rows]
+        data = {}
+        for name in columns or self.columns(product):
+            stored, level, dtype, encoding = self._columns[self._layout[product][name]]
+            if level == 'quota':
+                values = stored[run]
+            else:
+                values = stored if rows is None else stored[rows]
+            values = values.astype('datetime64[M]') if encoding == 'month' else values
+            data[name] = values.astype(dtype)
+        return pd.DataFrame(data, index=pd.RangeIndex(len(run)))
+
+    @property
+    def nbytes(self):
+        return int(self._run.nbytes + sum(stored.nbytes for stored, _, _, _ in self._columns.values()))
+
+
+def read_expanded_scenario(path, columns=None, ids=None, months=None):
+    """
+    Reads both expanded frames of an artifact into an ExpandedScenario.
+
+    Parameters:
+    path (str): Artifact directory.
+    columns (dict): Columns to read per product, e.g. {'consorcio': [...]} (default: all).
+    ids (list): Quota ids to read (default: all).
+    months (tuple): (first, last) months to read, inclusive; either can be None.
+
+    Returns:
+    ExpandedScenario
+    """
+    frames = []
+    for product in PRODUCTS:
+        product_columns = (columns or {}).get(product)
+        if product_columns is not None:
+            product_columns = list(dict.fromkeys(['id', 'month', *product_columns]))
+        frames.append(read_expanded(path, product, columns=product_columns, ids=ids, months=months))
+    return ExpandedScenario(*frames)
@@ -0,0 +1,131 @@
+"""
+Checks that every expansion path gives the frames of the reference loop, on synthetic data, offline.
+
+Usage:
+    python benchmarks/check_engines.py
+    python benchmarks/check_engines.py --quotas 1000 --seed 3
+
+For each parameter set (default, compounded, collateral fraction, fixed Circulana fee) the
+frames of expandir_cotas(engine='loop') are compared with the vectorized and parallel
+engines, iter_expandir_cotas, write_expanded_dataset read back with read_expanded, and
+reexpandir_cotas over a subset of ids. Floats must agree within RTOL, or ATOL for the values
+rounded to 4 decimals by the currency conversions. The script exits with status 1 on any
+difference.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import data_cache
+from synthetic_data import write_group_file, write_reference_files
+
+RTOL = 1e-9
+ATOL = 2e-4
+PARAMETER_SETS = {
+    'default': {},
+    'compounded': {'compounded': True},
+    'colateral': {'colateral': 0.4},
+    'compounded_colateral': {'compounded': True, 'colateral': 0.4},
+    'tx_adm_circulana': {'tx_adm_circulana': 0.05},
+}
+
+
+def compare_frames(expected, actual):
+    """
+    Compares two expanded frames column by column.
+
+    Returns:
+    list: One message per differing column (names, dtypes, lengths or values).
+    """
+    if list(expected.columns) != list(actual.columns):
+        return [f"columns {list(expected.columns)} != {list(actual.columns)}"]
+    if len(expected) != len(actual):
+        return [f"{len(expected)} rows != {len(actual)} rows"]
+    problems = []
+    for col in expected.columns:
+        x, y = expected[col].to_numpy(), actual[col].to_numpy()
+        if expected[col].dtype != actual[col].dtype:
+            problems.append(f"{col}: dtype {expected[col].dtype} != {actual[col].dtype}")
+        if x.dtype.kind in 'fc' or y.dtype.kind in 'fc':
+            same = np.isclose(x.astype(float), y.astype(float), rtol=RTOL, atol=ATOL, equal_nan=True)
+        else:
+            same = x == y
+        if not same.all():
+            first = np.flatnonzero(~same)[0]
+            problems.append(f"{col}: {int((~same).sum())} rows differ, e.g. row {first}: {x[first]!r} != {y[first]!r}")
+    return problems
+
+
+def run(n_quotas=300, data_dir=None, seed=0):
+    """
+    Runs every expansion path for every parameter set.
+
+    Returns:
+    list: (parameter set, path, product, message) of every difference.
+    """
+    data_dir = data_dir or tempfile.mkdtemp(prefix='simulacao-check-')
+    write_reference_files(data_dir, seed=seed)
+    # Serve every input from the synthetic directory and never touch Google Drive.
+    data_cache.DATA_DIR = data_dir
+    data_cache.OFFLINE_DIR = data_dir
+
+    from artifacts import read_expanded
+    from cotas_processor import expandir_cotas, iter_expandir_cotas, reexpandir_cotas, write_expanded_dataset
+    from load_functions import load_and_preprocess_grupo, path_dict_to_df
+
+    group_file = f'grupo_{n_quotas}.csv'
+    write_group_file(os.path.join(data_dir, group_file), n_quotas, seed=seed)
+    df_grupo = load_and_preprocess_grupo(group_file)
+    apys_df = path_dict_to_df('aave')
+    ids = df_grupo['id'].unique()
+    changed_ids = ids[::7]
+
+    failures = []
+    for name, params in PARAMETER_SETS.items():
+        expected = expandir_cotas(df_grupo, apys_df=apys_df, engine='loop', **params)
+        # The loop frames with the changed quotas dropped, as a stale expansion to refresh.
+        stale = [frame[~frame['id'].isin(changed_ids)].reset_index(drop=True) for frame in expected]
+        artifact_path = os.path.join(data_dir, f'artifact_{name}')
+        write_expanded_dataset(df_grupo, artifact_path, apys_df=apys_df, chunk_size=37, **params)
+        chunks = list(iter_expandir_cotas(df_grupo, apys_df=apys_df, chunk_size=41, **params))
+        paths = {
+            'vectorized': expandir_cotas(df_grupo, apys_df=apys_df, **params),
+            'parallel': expandir_cotas(df_grupo, apys_df=apys_df, engine='parallel', max_workers=2, chunk_size=53, **params),
+            'iter_expandir_cotas': tuple(pd.concat([chunk[i] for chunk in chunks], ignore_index=True) for i in range(2)),
+            'write_expanded_dataset': (read_expanded(artifact_path, 'consorcio'), read_expanded(artifact_path, 'circulana')),
+            'reexpandir_cotas': reexpandir_cotas(df_grupo, changed_ids, *stale, apys_df=apys_df, **params),
+        }
+        for path_name, frames in paths.items():
+            for product, expected_frame, actual_frame in zip(('consorcio', 'circulana'), expected, frames):
+                for message in compare_frames(expected_frame.reset_index(drop=True), actual_frame.reset_index(drop=True)):
+                    failures.append((name, path_name, product, message))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quotas', type=int, default=300, help='Number of synthetic quotas.')
+    parser.add_argument('--data-dir', help='Directory for the synthetic data (default: a temporary directory).')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    failures = run(args.quotas, data_dir=args.data_dir, seed=args.seed)
+    for name, path_name, product, message in failures:
+        print(f"MISMATCH {name} / {path_name} / {product}: {message}")
+    if failures:
+        return 1
+    print(f"All expansion paths match the loop engine on {len(PARAMETER_SETS)} parameter sets.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
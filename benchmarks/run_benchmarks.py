@@ -0,0 +1,177 @@
+"""
+Times the simulation pipeline on synthetic data, offline.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 100 1000 10000 --output results.json
+    python benchmarks/run_benchmarks.py --baseline baseline.json --threshold 0.25
+
+Each benchmark is timed --repeat times and the fastest run is kept. With --baseline the
+results are compared with a previous results file and the script exits with status 1 when
+any benchmark got slower than the threshold allows.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import warnings
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import data_cache
+from synthetic_data import write_group_file, write_reference_files
+
+DEFAULT_SIZES = [100, 1000, 10000]
+# Differences below this are treated as noise by the regression check.
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def _time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run(sizes, repeat=3, data_dir=None, with_loop=False, seed=0):
+    """
+    Runs every benchmark at every size.
+
+    Parameters:
+    sizes (list): Numbers of quotas of the synthetic groups.
+    repeat (int): Runs per benchmark; the fastest is reported.
+    data_dir (str): Directory for the synthetic files (default: a temporary directory).
+    with_loop (bool): Also time the reference loop engine of expandir_cotas (slow).
+    seed (int): Random seed of the synthetic data.
+
+    Returns:
+    list: One dict per (benchmark, size) with the timings.
+    """
+    data_dir = data_dir or tempfile.mkdtemp(prefix='simulacao-bench-')
+    write_reference_files(data_dir, seed=seed)
+    # Serve every input from the synthetic directory and never touch Google Drive.
+    data_cache.DATA_DIR = data_dir
+    data_cache.OFFLINE_DIR = data_dir
+
+    from load_functions import (aplication_cdi, calcular_rentabilidade_mes, convert_currency,
+                                find_corrected_values, load_and_preprocess_grupo, path_dict_to_df)
+    from cotas_processor import expandir_cotas, sweep_expandir_cotas
+    from graphics import plot_quota_comparison
+    from montecarlo import simulate_profits
+    # st.pyplot outside `streamlit run` logs a warning on every call.
+    logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').addFilter(lambda record: False)
+
+    apys_df = path_dict_to_df('aave')
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        group_file = f'grupo_{size}.csv'
+        write_group_file(os.path.join(data_dir, group_file), size, seed=seed)
+        df_grupo = load_and_preprocess_grupo(group_file)
+        dates = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 1400, size), unit='D')
+        amounts = rng.uniform(1000, 300000, size)
+        years = rng.integers(2020, 2025, size)
+
+        def scalar_calls(function):
+            return lambda: [function(date, amount) for date, amount in zip(dates, amounts)]
+
+        df_consorcio, df_circulana = expandir_cotas(df_grupo, apys_df=apys_df)
+        plotted_ids = df_consorcio['id'].unique()[:3]
+
+        def plot_quotas():
+            for quota_id in plotted_ids:
+                plot_quota_comparison(df_consorcio, df_circulana, quota_id)
+                plt.close('all')
+
+        benchmarks = {
+            'load_and_preprocess_grupo': lambda: load_and_preprocess_grupo(group_file, use_cache=False),
+            'load_and_preprocess_grupo_cached': lambda: load_and_preprocess_grupo(group_file),
+            'expandir_cotas': lambda: expandir_cotas(df_grupo, apys_df=apys_df),
+            'expandir_cotas_compounded': lambda: expandir_cotas(df_grupo, apys_df=apys_df, compounded=True),
+            # 10 fees x 5 collaterals.
+            'sweep_expandir_cotas_50': lambda: sweep_expandir_cotas(df_grupo, apys_df=apys_df, tx_adm_circulana=list(np.linspace(0.01, 0.2, 10)), colateral=[None, 0.2, 0.4, 0.6, 0.8]),
+            'simulate_profits_1000': lambda: simulate_profits(df_circulana, apys_df, n_paths=1000),
+            'convert_currency': scalar_calls(convert_currency),
+            'find_corrected_values': lambda: [find_corrected_values(amount, year, year + 1) for amount, year in zip(amounts, years)],
+            'aplication_cdi': lambda: [aplication_cdi(amount, date) for date, amount in zip(dates, amounts)],
+            'calcular_rentabilidade_mes': lambda: [calcular_rentabilidade_mes(amount, date, apys_df=apys_df) for date, amount in zip(dates, amounts)],
+            'plot_quota_comparison': plot_quotas,
+        }
+        if with_loop:
+            benchmarks['expandir_cotas_loop'] = lambda: expandir_cotas(df_grupo, apys_df=apys_df, engine='loop')
+
+        for name, function in benchmarks.items():
+            timings = _time(function, repeat)
+            results.append({'benchmark': name, 'size': size, 'seconds': min(timings), 'timings': timings})
+            print(f"{name:<28} {size:>8} {min(timings):>10.4f}s", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a baseline.
+
+    Returns:
+    list: (benchmark, size, baseline seconds, seconds) of every benchmark slower than
+    baseline * (1 + threshold) by more than MIN_REGRESSION_SECONDS.
+    """
+    previous = {(row['benchmark'], row['size']): row['seconds'] for row in baseline['results']}
+    regressions = []
+    for row in results:
+        base = previous.get((row['benchmark'], row['size']))
+        if base is not None and row['seconds'] > base * (1 + threshold) and row['seconds'] - base > MIN_REGRESSION_SECONDS:
+            regressions.append((row['benchmark'], row['size'], base, row['seconds']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of quotas to benchmark.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='Previous results file to check for regressions.')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown relative to the baseline (0.25 = 25%%).')
+    parser.add_argument('--data-dir', help='Directory for the synthetic data (default: a temporary directory).')
+    parser.add_argument('--with-loop', action='store_true', help='Also time the reference loop engine (slow).')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    results = run(args.sizes, repeat=args.repeat, data_dir=args.data_dir, with_loop=args.with_loop, seed=args.seed)
+    report = {
+        'created_at': pd.Timestamp.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, size, base, seconds in regressions:
+            print(f"REGRESSION {name} (size {size}): {base:.4f}s -> {seconds:.4f}s")
+        if regressions:
+            return 1
+        print(f"No regressions above {args.threshold:.0%}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import numpy as np
+import pandas as pd
+
+APY_FILE_NAMES = ['apys_aave_v2_USDC.csv', 'apys_compound_USDC.csv', 'apys_uniswap_v3-USDC-USDT.csv', 'apys_balancer_v3_USDC.csv']
+
+
+def _brl_number(values, decimals):
+    """Formats numbers like the source CSVs: '.' for thousands and ',' for decimals."""
+    return [f"{value:,.{decimals}f}".replace(',', 'X').replace('.', ',').replace('X', '.') for value in values]
+
+
+def write_reference_files(directory, seed=0):
+    """
+    Writes synthetic FX, CDI, FIPE and APY files in the layout of the real inputs.
+
+    Parameters:
+    directory (str): Output directory.
+    seed (int): Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    # USD/BRL quotes on business-like days, in the investing.com export layout.
+    dates = pd.date_range('2019-06-01', '2025-03-01', freq='D')
+    dates = dates[rng.random(len(dates)) < 0.7]
+    rates = _brl_number(5 + np.cumsum(rng.normal(0, 0.02, len(dates))), 4)
+    df_usd = pd.DataFrame({'Data': dates.strftime('%d-%m-%Y'), 'Último': rates, 'Abertura': rates, 'Máxima': 0, 'Mínima': 0, 'Vol.': 0, 'Var%': 0})
+    df_usd.to_csv(os.path.join(directory, 'usd-variation.csv'), index=False)
+    df_usd.to_csv(os.path.join(directory, 'USD_BRL.csv'), index=False)
+
+    # Monthly CDI, with a couple of missing months like the real series.
+    months = pd.date_range('2019-01-01', '2024-12-01', freq='MS').delete([30, 41])
+    pd.DataFrame({
+        'Data': months.strftime('%Y-%m'),
+        'Taxa de juros - CDI / Over - acumulada no mês': _brl_number(rng.uniform(0.2, 1.1, len(months)), 2),
+    }).to_csv(os.path.join(directory, 'cdi.csv'), index=False)
+
+    # FIPE prices per model and year, with a gap in the first model.
+    rows = []
+    for model in range(5):
+        row = {'modelo': f'modelo_{model}', 'inicio_grupo': '2020-01-01', 'termino_grupo': '2030-01-01'}
+        base = rng.uniform(50000, 300000)
+        for year in range(2020, 2026):
+            row[f'valor_{year}'] = _brl_number([base * 1.05 ** (year - 2020) * rng.uniform(0.97, 1.03)], 2)[0]
+        rows.append(row)
+    rows[0]['valor_2021'] = ''
+    pd.DataFrame(rows).to_csv(os.path.join(directory, 'FIPE-GRUPO-655-FIPE.csv'), index=False)
+
+    # Daily APYs per protocol, with one month missing.
+    apy_dates = pd.date_range('2020-03-01', '2025-01-31', freq='D')
+    apy_dates = apy_dates[~((apy_dates.year == 2022) & (apy_dates.month == 6))]
+    for file_name in APY_FILE_NAMES:
+        pd.DataFrame({
+            'DATE': apy_dates.strftime('%Y-%m-%d'),
+            'APY': rng.uniform(1, 8, len(apy_dates)),
+            'APY_REWARD': 0.0,
+            'APY_BASE': 0.0,
+            'TVL': 1.0,
+            'GAS_PRICE_MED': rng.uniform(0.5, 3, len(apy_dates)),
+        }).to_csv(os.path.join(directory, file_name), index=False)
+
+
+def write_group_file(filepath, n_quotas, seed=0):
+    """
+    Writes a synthetic Santander group CSV with n_quotas quotas, readable by load_and_preprocess_grupo.
+
+    About 30% of the quotas are canceled and 60% contemplated; some quotas have two snapshots
+    (data_info), and some dates fall on the first of the month to exercise the edge cases.
+
+    Parameters:
+    filepath (str): Output CSV path.
+    n_quotas (int): Number of distinct quotas.
+    seed (int): Random seed.
+
+    Returns:
+    int: Number of rows written.
+    """
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(np.arange(30_000_000, 31_000_000), n_quotas, replace=False)
+    venda = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 1500, n_quotas), unit='D')
+    canc = venda + pd.to_timedelta(rng.integers(60, 1200, n_quotas), unit='D')
+    canc = canc.where(~(rng.random(n_quotas) < 0.3), canc.to_period('M').to_timestamp())
+    canc = canc.where(rng.random(n_quotas) < 0.3)
+    cont = venda + pd.to_timedelta(rng.integers(0, 1200, n_quotas), unit='D')
+    cont = cont.where(~(rng.random(n_quotas) < 0.3), cont.to_period('M').to_timestamp())
+    cont = cont.where(rng.random(n_quotas) < 0.6)
+
+    snapshots = rng.integers(1, 3, n_quotas)
+    quota = np.repeat(np.arange(n_quotas), snapshots)
+    snapshot = np.arange(len(quota)) - np.repeat(np.cumsum(snapshots) - snapshots, snapshots)
+    n_rows = len(quota)
+
+    def date_strings(values):
+        return pd.Series(values[quota]).dt.strftime('%Y-%m-%d').to_numpy()
+
+    df = pd.DataFrame({
+        'id_quotas_santander': np.arange(n_rows),
+        'cd_grupo': 655,
+        'cd_cota': quota,
+        'cd_produto': 1,
+        'nm_situ_entrega_bem': 'x',
+        'created_at': '2025-01-01',
+        'is_processed': True,
+        'cd_versao_cota': 0,
+        'cd_tipo_pessoa': 'F',
+        'pz_comercializacao': 1,
+        'vl_lance_proprio': 0.0,
+        'nr_contrato': ids[quota],
+        'vl_bem_atual': np.round(rng.uniform(50000, 300000, n_quotas), 2)[quota],
+        'pc_tx_adm': rng.choice([14.0, 16.0, 18.0], n_quotas)[quota],
+        'pc_fundo_reserva': 2.0,
+        'pc_fc_pago': 10.0,
+        'pc_fr_pago': 1.0,
+        'pc_tx_pago': 1.0,
+        'pc_seguro': np.where(rng.random(n_quotas) < 0.2, np.nan, 0.05)[quota],
+        'pz_restante_grupo': 10,
+        'qt_parcela_a_pagar': 3,
+        'pz_contratado': rng.choice([60, 72, 80, 100], n_quotas)[quota],
+        'qt_parcela_paga': 3,
+        'pz_decorrido_grupo': 5,
+        'dt_entrega_bem': None,
+        'vl_lance_embutido': 0.0,
+        'vl_bem_corrigido': 1.0,
+        'vl_total_contrato': 1.0,
+        'qt_pc_atraso': 0,
+        'qt_pc_lance': 0,
+        'dt_venda': date_strings(venda),
+        'dt_canc': date_strings(canc),
+        'dt_contemplacao': date_strings(cont),
+        'data_info': (pd.Timestamp('2025-02-01') + pd.to_timedelta(snapshot, unit='D')).strftime('%Y-%m-%d %H:%M:%S'),
+        'vl_devolver': 100.0,
+    })
+    df.to_csv(filepath, index=False)
+    return n_rows
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from instrumentation import instrumented
+from load_functions import NO_MONTH
+
+COST_CUBE_KEYS = ['TX_adm_%', 'month', 'contemplated', 'canceled', 'sale_month']
+# Columns summed per product; circulana has no reserve fund or insurance.
+COST_CUBE_COLUMNS = {
+    'consorcio': ['FC_paid', 'TX_adm_monthly', 'TX_adm_paid', 'FR_paid', 'seguro_paid'],
+    'circulana': ['FC_paid', 'TX_adm_monthly', 'TX_adm_paid'],
+}
+# Expanded columns needed to build the cube, for ExpandedScenario.frame.
+COST_CUBE_SOURCE_COLUMNS = {
+    'consorcio': ['id', 'month', 'TX_adm_%', 'contemplated', 'canceled', *COST_CUBE_COLUMNS['consorcio']],
+    'circulana': COST_CUBE_COLUMNS['circulana'],
+}
+
+
+@instrumented('cube.build', rows=len)
+def build_cost_cube(df_expanded_consorcio, df_expanded_circulana, df_grupo):
+    """
+    Sums the monthly costs of both products by (TX_adm_%, month, contemplated, canceled, sale_month).
+
+    Built once per scenario, it replaces the row-level frames in the group overview: every
+    total and time series of the overview is a sum over some cells of the cube.
+
+    Parameters:
+    df_expanded_consorcio (pd.DataFrame): Consorcio expansion (at least COST_CUBE_SOURCE_COLUMNS).
+    df_expanded_circulana (pd.DataFrame): Circulana expansion, with the same rows as the consorcio one.
+    df_grupo (pd.DataFrame): Group, sorted by id, with the dt_venda_month codes of the loader.
+
+    Returns:
+    pd.DataFrame: One row per cell with the key columns, 'n_rows' and one
+    '<product>_<column>' sum per column of COST_CUBE_COLUMNS. TX_adm_% is the consorcio
+    fraction (0.16 for 16%) and sale_month the month code of dt_venda.
+    """
+    ids = df_expanded_consorcio['id'].to_numpy()
+    grupo_ids = df_grupo['id'].to_numpy()
+    position = np.minimum(np.searchsorted(grupo_ids, ids), max(len(grupo_ids) - 1, 0))
+    sale_month = df_grupo['dt_venda_month'].to_numpy()[position] if len(grupo_ids) else np.full(len(ids), NO_MONTH)
+    sale_month = np.where(grupo_ids[position] == ids, sale_month, NO_MONTH) if len(grupo_ids) else sale_month
+
+    data = {key: df_expanded_consorcio[key].to_numpy() for key in COST_CUBE_KEYS if key != 'sale_month'}
+    data['sale_month'] = sale_month
+    data['n_rows'] = np.ones(len(ids), dtype=np.int64)
+    for product, df in (('consorcio', df_expanded_consorcio), ('circulana', df_expanded_circulana)):
+        for col in COST_CUBE_COLUMNS[product]:
+            data[f'{product}_{col}'] = df[col].to_numpy()
+    # Rows with a missing key (no fee or month) still count in every total.
+    return pd.DataFrame(data).groupby(COST_CUBE_KEYS, sort=True, as_index=False, dropna=False).sum()
+
+
+def select_cells(cube, tx_adm_filter=None, month=None, sale_month=None):
+    """
+    Cells of the cube matching the filters.
+
+    Parameters:
+    cube (pd.DataFrame): Cube from build_cost_cube.
+    tx_adm_filter (float): Administration fee in percent, as in df_grupo['TX_adm_%'].
+    month (str): Month of the rows, 'YYYY-MM'.
+    sale_month (str): Month of the quotas' dt_venda, 'YYYY-MM'.
+    """
+    mask = np.ones(len(cube), dtype=bool)
+    if tx_adm_filter:
+        mask &= np.isclose(cube['TX_adm_%'].to_numpy(), tx_adm_filter / 100)
+    if month:
+        mask &= cube['month'].to_numpy() == np.datetime64(month, 'M').astype('datetime64[ns]')
+    if sale_month:
+        mask &= cube['sale_month'].to_numpy() == np.datetime64(sale_month, 'M').astype(np.int64)
+    return cube[mask]
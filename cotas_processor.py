@@ -1,10 +1,50 @@
+import itertools
+import math
+import multiprocessing
+import os
 import numpy as np
 import warnings
 import pandas as pd
-from load_functions import convert_currency, calcular_rentabilidade_mes, find_corrected_values, aplication_cdi
+from concurrent.futures import ProcessPoolExecutor
+from artifacts import ExpandedArtifactWriter
+from instrumentation import instrumented, stage
+from load_functions import convert_currency, calcular_rentabilidade_mes, find_corrected_values, aplication_cdi, calcular_rentabilidade_mes_many, convert_currency_many, find_corrected_values_many, DataFrameLoader, get_apy_monthly_table, month_codes, warm_reference_tables
 
-def expandir_cotas(df, apys_df=None, compounded=False, tx_adm_circulana=None):
-    """Expand the DataFrame for each month."""
+LAST_SIMULATION_MONTH = pd.Timestamp('2025-02-01')
+
+@instrumented('expand.expandir_cotas', rows=lambda frames: len(frames[0]))
+def expandir_cotas(df, apys_df=None, compounded=False, tx_adm_circulana=None, engine='vectorized', max_workers=None, chunk_size=None, colateral=None):
+    """
+    Expand the DataFrame for each month.
+
+    Parameters:
+    df (pd.DataFrame): Group DataFrame, as returned by load_and_preprocess_grupo.
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+    compounded (bool): Whether the collateral yield is reinvested month to month. Profits
+        are then the gain of the reinvested position over the initial collateral.
+    tx_adm_circulana (float): Circulana administration fee. Defaults to the quota's own fee.
+    engine (str): 'vectorized' (default) computes the whole group at once over a flat
+        (quota, month) layout; 'parallel' runs the vectorized engine over shards of quota ids
+        in a process pool; 'loop' runs the per-quota, per-month reference implementation.
+    max_workers (int): Number of worker processes for the 'parallel' engine (default: CPU count).
+    chunk_size (int): Number of quotas per shard for the 'parallel' engine.
+    colateral (float): Fraction of the contemplated good, in dollars, deposited as collateral
+        (the variant of analise/teste.py). By default the collateral is the good's value minus
+        the FC already paid.
+
+    Returns:
+    tuple: (df_expanded_consorcio, df_expanded_circulana)
+    """
+    if engine == 'loop':
+        return _expandir_cotas_loop(df, apys_df=apys_df, compounded=compounded, tx_adm_circulana=tx_adm_circulana, colateral=colateral)
+    if engine == 'vectorized':
+        return _expandir_cotas_vectorized(df, apys_df=apys_df, tx_adm_circulana=tx_adm_circulana, colateral=colateral, compounded=compounded)
+    if engine == 'parallel':
+        return _expandir_cotas_parallel(df, apys_df=apys_df, tx_adm_circulana=tx_adm_circulana, max_workers=max_workers, chunk_size=chunk_size, colateral=colateral, compounded=compounded)
+    raise ValueError("Invalid engine. Use 'vectorized', 'parallel' or 'loop'.")
+
+def _expandir_cotas_loop(df, apys_df=None, compounded=False, tx_adm_circulana=None, colateral=None):
+    """Expand the DataFrame for each month, one quota and one month at a time."""
     expanded_rows_consorcio = []
     expanded_rows_circulana = []
     grouped = df.groupby('id')
@@ -47,7 +87,7 @@ def expandir_cotas(df, apys_df=None, compounded=False, tx_adm_circulana=None):
         end_date = min(filter(pd.notna, [
             pd.Timestamp(dt_cancel) if pd.notna(dt_cancel) else None,
             start_date + pd.DateOffset(months=contracted_period),
-            pd.Timestamp('2025-02-01')
+            LAST_SIMULATION_MONTH
         ]))
 
         months = pd.date_range(start=start_date, end=end_date, freq='MS')
@@ -94,7 +134,7 @@ def expandir_cotas(df, apys_df=None, compounded=False, tx_adm_circulana=None):
                 if not bem_contemplacao:
                     bem_contemplacao = max_vl_bem_corrigido
                     bem_contemplacao_dolar = convert_currency(date=month, amount=bem_contemplacao)
-                    valor_colateral = bem_contemplacao - FC_already_paid
+                    valor_colateral = bem_contemplacao - FC_already_paid if colateral is None else colateral * bem_contemplacao_dolar
                 if consorcio_cdi == 0.0:
                     consorcio_cdi = bem_contemplacao
                 else:
@@ -103,19 +143,18 @@ def expandir_cotas(df, apys_df=None, compounded=False, tx_adm_circulana=None):
 
                 base_valor_colateral = valor_colateral if (not compounded or first_month) else rentabilidade_colateral
                 rentabilidade_colateral = calcular_rentabilidade_mes(valor=base_valor_colateral, data=month, apys_df=apys_df)
-                profits_colateral_dolar += rentabilidade_colateral - valor_colateral
+                profits_colateral_dolar += rentabilidade_colateral - base_valor_colateral
 
                 base_valor_bem = bem_contemplacao_dolar if (not compounded or first_month) else rentabilidade_colateral_bem
                 rentabilidade_colateral_bem = calcular_rentabilidade_mes(valor=base_valor_bem, data=month, apys_df=apys_df)
-                profits_bem_dolar += rentabilidade_colateral_bem - bem_contemplacao_dolar
+                profits_bem_dolar += rentabilidade_colateral_bem - base_valor_bem
 
                 rentabilidade_colateral_real = convert_currency(date=month, amount=rentabilidade_colateral, to_currency='brl')
                 rentabilidade_bem_contemplacao_real = convert_currency(date=month, amount=rentabilidade_colateral_bem, to_currency='brl')
                 profits_bem = convert_currency(date=month, amount=profits_bem_dolar, to_currency='brl')
                 profits_colateral = convert_currency(date=month, amount=profits_colateral_dolar, to_currency='brl')
                 bem_contemplacao_dolar_show = convert_currency(date=month, amount=bem_contemplacao_dolar+profits_bem_dolar, to_currency='brl')
-                if not first_month:
-                    first_month = False
+                first_month = False
 
             common_values = {
                 "id": cota_id,
@@ -155,17 +194,514 @@ def expandir_cotas(df, apys_df=None, compounded=False, tx_adm_circulana=None):
                 "TX_adm_%": tx_adm_circulana,
                 "colateral_w_profits": rentabilidade_colateral_real,
                 "bem_contemplacao_w_profits": rentabilidade_bem_contemplacao_real,
-                "colateral_initial": valor_colateral,
+                "colateral_initial": valor_colateral if colateral is None else (colateral * bem_contemplacao if contemplated else 0.0),
                 "TX_adm_paid": TX_already_paid_circulana if not canceled else 0.0,
                 "TX_adm_monthly": tx_adm_circulana_value,
                 "profits_colateral": profits_colateral,
                 "profits_bem": profits_bem,
                 "bem_contemplacao_dolar": bem_contemplacao_dolar_show,
-                "bem_contemplacao_dolar_colateral": bem_contemplacao_dolar_show * (valor_colateral / bem_contemplacao) if bem_contemplacao else 0.0,
+                "bem_contemplacao_dolar_colateral": (bem_contemplacao_dolar_show * (valor_colateral / bem_contemplacao) if colateral is None else bem_contemplacao_dolar_show * colateral) if bem_contemplacao else 0.0,
             }
             circulana_dict = {**common_values, **circulana_specific}
             expanded_rows_circulana.append(circulana_dict)
 
     df_expanded_consorcio = pd.DataFrame(expanded_rows_consorcio)
     df_expanded_circulana = pd.DataFrame(expanded_rows_circulana)
-    return df_expanded_consorcio, df_expanded_circulana
\ No newline at end of file
+    return df_expanded_consorcio, df_expanded_circulana
+
+
+def _month_starts(codes):
+    """First day of the month for the given month codes, as datetime64[ns]."""
+    return codes.astype('datetime64[M]').astype('datetime64[ns]')
+
+def _segment_accumulate(ufunc, values, quota, pos, n_quotas, max_len, fill=0.0):
+    """
+    Applies ufunc.accumulate over each quota's months of a flat (quota, month) array.
+
+    Leading axes of values (e.g. one per scenario) are accumulated independently.
+    """
+    grid = np.full(values.shape[:-1] + (n_quotas, max_len), fill, dtype=np.float64)
+    grid[..., quota, pos] = values
+    return ufunc.accumulate(grid, axis=-1)[..., quota, pos]
+
+def _latest_quota_rows(df):
+    """Last row of each quota, sorted by id, as read by the reference loop."""
+    return df.groupby('id').tail(1).sort_values('id', kind='stable')
+
+def _quota_month_ranges(last_rows, today):
+    """
+    Returns the sale date, contracted period, first month code and number of months of each quota.
+
+    Months are the month starts from dt_venda up to the contracted period, the cut-off month
+    or the cancellation, whichever comes first. A month starting exactly on dt_canc is already
+    canceled and is not emitted.
+    """
+    start_date = pd.to_datetime(last_rows['dt_venda'])
+    elapsed_months = ((today - start_date).dt.days // 30).to_numpy()
+    contracted_period = np.minimum(last_rows['contracted_period'].to_numpy(), elapsed_months)
+    start_date = start_date.to_numpy('datetime64[ns]')
+    dt_cancel = pd.to_datetime(last_rows['dt_canc']).to_numpy('datetime64[ns]')
+
+    start_code = month_codes(start_date)
+    first_code = start_code + (start_date > _month_starts(start_code))
+    last_code = np.minimum(start_code + contracted_period, month_codes(np.datetime64(LAST_SIMULATION_MONTH, 'ns')))
+    has_cancel = ~np.isnat(dt_cancel)
+    cancel_code = month_codes(dt_cancel)
+    cancel_limit = cancel_code - (dt_cancel == _month_starts(cancel_code))
+    last_code = np.where(has_cancel, np.minimum(last_code, cancel_limit), last_code)
+    n_months = np.clip(last_code - first_code + 1, 0, None).astype(np.int64)
+    return start_date, contracted_period, first_code, n_months
+
+def resolve_tx_adm_circulana(df, tx_adm_circulana=None, today=None):
+    """
+    Returns the Circulana administration fee applied to the group.
+
+    Like the reference loop, when no fee is given the fee of the first expanded quota
+    (by id) applies to the whole group.
+    """
+    if tx_adm_circulana is not None:
+        return tx_adm_circulana
+    last_rows = _latest_quota_rows(df)
+    n_months = _quota_month_ranges(last_rows, today or pd.Timestamp.today())[3]
+    with_rows = np.flatnonzero(n_months)
+    return last_rows['TX_adm_%'].to_numpy(dtype=np.float64)[with_rows[0]] / 100 if len(with_rows) else np.nan
+
+def _expandir_cotas_vectorized(df, apys_df=None, tx_adm_circulana=None, colateral=None, compounded=False):
+    """Expand the DataFrame for each month, computing every quota and month at once."""
+    with stage('expand.latest_rows', rows=len(df)):
+        last_rows = _latest_quota_rows(df)
+        today = pd.Timestamp.today()
+        tx_adm_circulana = resolve_tx_adm_circulana(last_rows, tx_adm_circulana, today)
+    with stage('expand.columns') as timed:
+        consorcio_columns, circulana_columns = _expand_columns(last_rows, apys_df, tx_adm_circulana, today, colateral, compounded)
+        timed.rows = len(consorcio_columns['id'])
+    with stage('expand.frames', rows=timed.rows):
+        return pd.DataFrame(consorcio_columns), pd.DataFrame(circulana_columns)
+
+def _expand_columns(last_rows, apys_df, tx_adm_circulana, today, colateral=None, compounded=False):
+    """
+    Expands the given quotas (one row per id, sorted by id) over a flat (quota, month) layout.
+
+    Returns:
+    tuple: dicts of column arrays for the consorcio and circulana frames.
+    """
+    ids = last_rows['id'].to_numpy()
+    vl_bem = last_rows['vl_bem'].to_numpy(dtype=np.float64)
+    tx_adm_percent = last_rows['TX_adm_%'].to_numpy(dtype=np.float64)
+    fr_percent = last_rows['FR_%'].to_numpy(dtype=np.float64)
+    seguro_percent = np.nan_to_num(last_rows['Seguro_%'].to_numpy(dtype=np.float64), nan=0.0)
+    embedded_bid_vl = last_rows['embedded_bid_vl'].to_numpy()
+    dt_contemplacao = pd.to_datetime(last_rows['dt_contemplacao']).to_numpy('datetime64[ns]')
+    start_date, contracted_period, first_code, n_months = _quota_month_ranges(last_rows, today)
+
+    # Flat (quota, month) layout: quota index and position of each row inside its quota.
+    n_quotas = len(ids)
+    n_rows = int(n_months.sum())
+    max_len = int(n_months.max()) if n_quotas else 0
+    offsets = np.cumsum(n_months) - n_months
+    quota = np.repeat(np.arange(n_quotas), n_months)
+    pos = np.arange(n_rows) - offsets[quota]
+    month_code = first_code[quota] + pos
+    month = _month_starts(month_code)
+
+    def accumulate(ufunc, values, fill=0.0):
+        return _segment_accumulate(ufunc, values, quota, pos, n_quotas, max_len, fill)
+
+    # Corrected value of the good: FIPE correction from the sale year, never decreasing.
+    start_year = start_date.astype('datetime64[Y]').astype(np.int64) + 1970
+    month_year = month.astype('datetime64[Y]').astype(np.int64) + 1970
+    vl_bem_q = vl_bem[quota]
+    vl_bem_corrigido = np.maximum(find_corrected_values_many(vl_bem_q, start_year[quota], month_year), vl_bem_q)
+    vl_bem_corrigido = accumulate(np.maximum, vl_bem_corrigido)
+
+    period_q = contracted_period[quota]
+    fc_monthly = vl_bem_corrigido / period_q
+    tx_monthly = (tx_adm_percent[quota] / 100) * vl_bem_corrigido / period_q
+    fr_monthly = vl_bem_corrigido * (fr_percent[quota] / 100) / period_q
+    seguro_monthly = (seguro_percent[quota] / 100) * vl_bem_corrigido / period_q
+    FC_already_paid = accumulate(np.add, fc_monthly)
+    TX_already_paid = accumulate(np.add, tx_monthly)
+    FR_already_paid = accumulate(np.add, fr_monthly)
+
+    tx_adm_circulana_value = tx_adm_circulana * vl_bem_corrigido / period_q
+    invalid = ~np.isfinite(tx_adm_circulana_value)
+    if invalid.any():
+        warnings.warn(f"Overflow detected in {int(invalid.sum())} rows: tx_adm_circulana={tx_adm_circulana}")
+        tx_adm_circulana_value = np.where(invalid, np.nan, tx_adm_circulana_value)
+    TX_already_paid_circulana = accumulate(np.add, tx_adm_circulana_value)
+
+    # Contemplation: every month from dt_contemplacao on. The good is frozen at its
+    # corrected value in the first contemplated month.
+    contemplated = month >= dt_contemplacao[quota]
+    n_contemplated = np.bincount(quota, weights=contemplated, minlength=n_quotas).astype(np.int64)
+    is_contemplated_q = n_contemplated > 0
+    first_contemplated = (offsets + n_months - n_contemplated)[is_contemplated_q]
+    bem_contemplacao = np.zeros(n_quotas)
+    bem_contemplacao[is_contemplated_q] = vl_bem_corrigido[first_contemplated]
+    bem_contemplacao_dolar = np.zeros(n_quotas)
+    if is_contemplated_q.any():
+        bem_contemplacao_dolar[is_contemplated_q] = convert_currency_many(month[first_contemplated], bem_contemplacao[is_contemplated_q])
+    valor_colateral = np.zeros(n_quotas)
+    if colateral is None:
+        valor_colateral[is_contemplated_q] = bem_contemplacao[is_contemplated_q] - FC_already_paid[first_contemplated]
+        colateral_initial = valor_colateral
+    else:
+        valor_colateral[is_contemplated_q] = colateral * bem_contemplacao_dolar[is_contemplated_q]
+        colateral_initial = colateral * bem_contemplacao
+
+    rows = np.flatnonzero(contemplated)
+    rows_quota = quota[rows]
+    # CDI compounding over the contemplation window, from the prefix products of the series.
+    contemplation_month = np.zeros(n_quotas, dtype='datetime64[ns]')
+    contemplation_month[is_contemplated_q] = month[first_contemplated]
+    consorcio_cdi = np.zeros(n_rows)
+    if len(rows):
+        cdi_series = DataFrameLoader().load_cdi_series()
+        consorcio_cdi[rows] = bem_contemplacao[rows_quota] * cdi_series.growth_between(contemplation_month[rows_quota], month[rows])
+    profits_consorcio_cdi = np.zeros(n_rows)
+    profits_consorcio_cdi[rows] = consorcio_cdi[rows] - bem_contemplacao[rows_quota]
+    profits_consorcio_cdi = accumulate(np.add, profits_consorcio_cdi)
+
+    rentabilidade_colateral = np.zeros(n_rows)
+    rentabilidade_colateral_bem = np.zeros(n_rows)
+    profits_colateral_dolar = np.zeros(n_rows)
+    profits_bem_dolar = np.zeros(n_rows)
+    if len(rows) and compounded:
+        # Reinvested yield v_t = v_{t-1} * (1 + apym_t) - gas_t, solved in closed form:
+        # with growth G_t the product of (1 + apym) since contemplation, v_t = G_t * (v_0 - sum(gas_s / G_s)).
+        _, apym, gas_fee = get_apy_monthly_table(apys_df).lookup(month[rows])
+        growth = np.ones(n_rows)
+        growth[rows] = 1 + apym
+        growth = accumulate(np.multiply, growth, fill=1.0)
+        discounted_gas = np.zeros(n_rows)
+        discounted_gas[rows] = gas_fee / growth[rows]
+        discounted_gas = accumulate(np.add, discounted_gas)
+        for values, initial in ((rentabilidade_colateral, valor_colateral), (rentabilidade_colateral_bem, bem_contemplacao_dolar)):
+            values[rows] = growth[rows] * (initial[rows_quota] - discounted_gas[rows])
+        # The profit is the gain of the reinvested position over the initial deposit.
+        profits_colateral_dolar[rows] = rentabilidade_colateral[rows] - valor_colateral[rows_quota]
+        profits_bem_dolar[rows] = rentabilidade_colateral_bem[rows] - bem_contemplacao_dolar[rows_quota]
+    elif len(rows):
+        rentabilidade_colateral[rows] = calcular_rentabilidade_mes_many(valor_colateral[rows_quota], month[rows], apys_df=apys_df)
+        rentabilidade_colateral_bem[rows] = calcular_rentabilidade_mes_many(bem_contemplacao_dolar[rows_quota], month[rows], apys_df=apys_df)
+        profits_colateral_dolar[rows] = rentabilidade_colateral[rows] - valor_colateral[rows_quota]
+        profits_colateral_dolar = accumulate(np.add, profits_colateral_dolar)
+        profits_bem_dolar[rows] = rentabilidade_colateral_bem[rows] - bem_contemplacao_dolar[rows_quota]
+        profits_bem_dolar = accumulate(np.add, profits_bem_dolar)
+
+    def to_brl(amount):
+        converted = np.zeros(n_rows)
+        converted[rows] = convert_currency_many(month[rows], amount[rows], to_currency='brl')
+        return converted
+
+    bem_contemplacao_dolar_show = to_brl(bem_contemplacao_dolar[quota] + profits_bem_dolar)
+    bem_contemplacao_dolar_colateral = np.zeros(n_rows)
+    if colateral is None:
+        bem_contemplacao_dolar_colateral[rows] = bem_contemplacao_dolar_show[rows] * (valor_colateral[rows_quota] / bem_contemplacao[rows_quota])
+    else:
+        bem_contemplacao_dolar_colateral[rows] = bem_contemplacao_dolar_show[rows] * colateral
+
+    canceled = np.zeros(n_rows, dtype=bool)
+    common_values = {
+        "id": ids[quota],
+        "month": month,
+        "canceled": canceled,
+        "contemplated": contemplated,
+        "vl_bem": np.where(contemplated, bem_contemplacao[quota], vl_bem_corrigido),
+        "vl_bem_corrigido": vl_bem_corrigido,
+        "vl_devolver": np.zeros(n_rows),
+        "contracted_period": period_q,
+        "embedded_bid_vl": embedded_bid_vl[quota],
+        "FC_paid": fc_monthly,
+    }
+
+    tx_adm_q = tx_adm_percent[quota] / 100
+    consorcio_specific = {
+        "TX_adm_paid": TX_already_paid,
+        "FC_paid_%": np.minimum(FC_already_paid / vl_bem_q, 1.0),
+        "FC_paid_monthly": fc_monthly,
+        "TX_paid_%": np.minimum(TX_already_paid / (tx_adm_q * vl_bem_q), 1.0),
+        "FR_paid": FR_already_paid,
+        "FR_paid_%": np.minimum(FR_already_paid / (fr_percent[quota] / 100 * vl_bem_q), 1.0),
+        "FR_paid_monthly": fr_monthly,
+        "seguro_paid": seguro_monthly,
+        "Seguro_%": seguro_percent[quota],
+        "TX_adm_%": tx_adm_q,
+        "consorcio_w_profits": consorcio_cdi,
+        "profits_consorcio": profits_consorcio_cdi,
+        "TX_adm_monthly": tx_monthly,
+        "seguro_monthly": seguro_monthly,
+    }
+
+    circulana_specific = {
+        "FC_paid_%": np.minimum(FC_already_paid / vl_bem_q, 1.0),
+        "TX_paid_%": np.minimum(TX_already_paid_circulana / (tx_adm_circulana * vl_bem_q), 1.0),
+        "TX_adm_%": np.full(n_rows, tx_adm_circulana),
+        "colateral_w_profits": to_brl(rentabilidade_colateral),
+        "bem_contemplacao_w_profits": to_brl(rentabilidade_colateral_bem),
+        "colateral_initial": np.where(contemplated, colateral_initial[quota], 0.0),
+        "TX_adm_paid": TX_already_paid_circulana,
+        "TX_adm_monthly": tx_adm_circulana_value,
+        "profits_colateral": to_brl(profits_colateral_dolar),
+        "profits_bem": to_brl(profits_bem_dolar),
+        "bem_contemplacao_dolar": bem_contemplacao_dolar_show,
+        "bem_contemplacao_dolar_colateral": bem_contemplacao_dolar_colateral,
+    }
+
+    return {**common_values, **consorcio_specific}, {**common_values, **circulana_specific}
+
+# Arguments shared by every task of a worker process, set once by _init_expansion_worker.
+_worker_state = {}
+
+def _init_expansion_worker(apys_df, tx_adm_circulana, today, colateral=None, compounded=False):
+    _worker_state.update(apys_df=apys_df, tx_adm_circulana=tx_adm_circulana, today=today, colateral=colateral, compounded=compounded)
+
+def _expand_shard(last_rows):
+    return _expand_columns(last_rows, _worker_state['apys_df'], _worker_state['tx_adm_circulana'], _worker_state['today'], _worker_state['colateral'], _worker_state['compounded'])
+
+class _ColumnWriter:
+    """Fills preallocated output columns with shard results, in shard order."""
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.columns = {}
+
+    def write(self, offset, shard_columns):
+        for name, values in shard_columns.items():
+            if name not in self.columns:
+                self.columns[name] = np.empty(self.n_rows, dtype=values.dtype)
+            self.columns[name][offset:offset + len(values)] = values
+
+def _expandir_cotas_parallel(df, apys_df=None, tx_adm_circulana=None, max_workers=None, chunk_size=None, colateral=None, compounded=False):
+    """
+    Expand the DataFrame for each month, running shards of quota ids on a process pool.
+
+    Shards are contiguous ranges of sorted ids and their results are written in order into
+    preallocated columns, so the output is identical to the vectorized engine. Reference
+    tables are loaded before the pool starts; with the fork start method workers inherit
+    them (and apys_df) instead of receiving them with every task.
+    """
+    last_rows = _latest_quota_rows(df)
+    today = pd.Timestamp.today()
+    tx_adm_circulana = resolve_tx_adm_circulana(last_rows, tx_adm_circulana, today)
+    n_months = _quota_month_ranges(last_rows, today)[3]
+    if not n_months.sum():
+        consorcio_columns, circulana_columns = _expand_columns(last_rows, apys_df, tx_adm_circulana, today, colateral, compounded)
+        return pd.DataFrame(consorcio_columns), pd.DataFrame(circulana_columns)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = chunk_size or max(1, math.ceil(len(last_rows) / (max_workers * 4)))
+    starts = range(0, len(last_rows), chunk_size)
+    shards = [last_rows.iloc[start:start + chunk_size] for start in starts]
+    shard_rows = [int(n_months[start:start + chunk_size].sum()) for start in starts]
+
+    warm_reference_tables(apys_df)
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    consorcio = _ColumnWriter(int(n_months.sum()))
+    circulana = _ColumnWriter(int(n_months.sum()))
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_expansion_worker, initargs=(apys_df, tx_adm_circulana, today, colateral, compounded)) as executor:
+        offset = 0
+        for n_rows, (consorcio_columns, circulana_columns) in zip(shard_rows, executor.map(_expand_shard, shards)):
+            consorcio.write(offset, consorcio_columns)
+            circulana.write(offset, circulana_columns)
+            offset += n_rows
+    return pd.DataFrame(consorcio.columns), pd.DataFrame(circulana.columns)
+
+def iter_expandir_cotas(df, apys_df=None, tx_adm_circulana=None, chunk_size=1000, colateral=None, compounded=False):
+    """
+    Expand the DataFrame for each month, yielding the result in chunks of quotas.
+
+    Only one chunk of expanded rows is alive at a time, so peak memory depends on
+    chunk_size and not on the number of quotas in df.
+
+    Parameters:
+    df (pd.DataFrame): Group DataFrame, as returned by load_and_preprocess_grupo.
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+    tx_adm_circulana (float): Circulana administration fee. Defaults to the first quota's fee.
+    chunk_size (int): Number of quotas per chunk.
+    colateral (float): Collateral fraction (see expandir_cotas).
+    compounded (bool): Whether the collateral yield is reinvested month to month.
+
+    Yields:
+    tuple: (df_expanded_consorcio, df_expanded_circulana) for each chunk of quotas, in id order.
+    """
+    last_rows = _latest_quota_rows(df)
+    today = pd.Timestamp.today()
+    tx_adm_circulana = resolve_tx_adm_circulana(last_rows, tx_adm_circulana, today)
+    for start in range(0, len(last_rows), chunk_size):
+        consorcio_columns, circulana_columns = _expand_columns(last_rows.iloc[start:start + chunk_size], apys_df, tx_adm_circulana, today, colateral, compounded)
+        yield pd.DataFrame(consorcio_columns), pd.DataFrame(circulana_columns)
+
+def write_expanded_dataset(df, path, apys_df=None, tx_adm_circulana=None, chunk_size=1000, colateral=None, compounded=False):
+    """
+    Expand the DataFrame for each month and stream the result to an expanded artifact on disk.
+
+    Each chunk of quotas is written to the artifact's Parquet datasets as soon as it is
+    computed (see artifacts.ExpandedArtifactWriter).
+
+    Parameters:
+    df (pd.DataFrame): Group DataFrame, as returned by load_and_preprocess_grupo.
+    path (str): Output directory.
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+    tx_adm_circulana (float): Circulana administration fee. Defaults to the first quota's fee.
+    chunk_size (int): Number of quotas per chunk.
+    colateral (float): Collateral fraction (see expandir_cotas).
+    compounded (bool): Whether the collateral yield is reinvested month to month.
+
+    Returns:
+    int: Number of expanded rows written to each dataset.
+    """
+    writer = ExpandedArtifactWriter(path)
+    for df_consorcio, df_circulana in iter_expandir_cotas(df, apys_df=apys_df, tx_adm_circulana=tx_adm_circulana, chunk_size=chunk_size, colateral=colateral, compounded=compounded):
+        writer.write(df_consorcio, df_circulana)
+    writer.close()
+    return writer.n_rows
+
+def reexpandir_cotas(df, ids, df_expanded_consorcio, df_expanded_circulana, apys_df=None, tx_adm_circulana=None, colateral=None, compounded=False):
+    """
+    Recomputes the expanded rows of the given quotas and replaces them in previously expanded frames.
+
+    Meant for incremental refreshes (see snapshot_store.SnapshotStore.ingest): the rows of
+    every other quota are kept as they are. When no fee is given it is resolved on the whole
+    group as in a full expansion; if that changes the fee of the previous Circulana frame,
+    every quota depends on it and the whole group is expanded again.
+
+    Parameters:
+    df (pd.DataFrame): Updated group DataFrame, as returned by load_and_preprocess_grupo.
+    ids (array-like): Quota ids to recompute (ids missing from df are dropped from the result).
+    df_expanded_consorcio (pd.DataFrame): Previous consorcio expansion of the group.
+    df_expanded_circulana (pd.DataFrame): Previous circulana expansion of the group.
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+    tx_adm_circulana (float): Circulana administration fee. Defaults to the first quota's fee.
+    colateral (float): Collateral fraction the previous frames were expanded with (see expandir_cotas).
+    compounded (bool): Whether the previous frames were expanded with reinvested yields.
+
+    Returns:
+    tuple: (df_expanded_consorcio, df_expanded_circulana), sorted by id.
+    """
+    last_rows = _latest_quota_rows(df)
+    today = pd.Timestamp.today()
+    tx_adm_circulana = resolve_tx_adm_circulana(last_rows, tx_adm_circulana, today)
+    previous_tx = df_expanded_circulana['TX_adm_%'].to_numpy()[:1]
+    if len(previous_tx) and not np.isclose(previous_tx[0], tx_adm_circulana, equal_nan=True):
+        return _expandir_cotas_vectorized(df, apys_df=apys_df, tx_adm_circulana=tx_adm_circulana, colateral=colateral, compounded=compounded)
+
+    ids = np.asarray(ids)
+    with stage('expand.reexpandir_cotas') as timed:
+        consorcio_columns, circulana_columns = _expand_columns(last_rows[last_rows['id'].isin(ids)], apys_df, tx_adm_circulana, today, colateral, compounded)
+        timed.rows = len(consorcio_columns['id'])
+    frames = []
+    for df_expanded, columns in ((df_expanded_consorcio, consorcio_columns), (df_expanded_circulana, circulana_columns)):
+        kept = df_expanded[~df_expanded['id'].isin(ids)]
+        frames.append(pd.concat([kept, pd.DataFrame(columns)], ignore_index=True).sort_values('id', kind='stable', ignore_index=True))
+    return tuple(frames)
+
+SWEEP_METRICS = ['total_cost_consorcio', 'total_cost_circulana', 'TX_adm_paid_circulana', 'colateral_initial', 'profits_colateral']
+
+@instrumented('expand.sweep', rows=lambda frames: len(frames[0]))
+def sweep_expandir_cotas(df, apys_df=None, tx_adm_circulana=(None,), colateral=(None,)):
+    """
+    Evaluates every combination of tx_adm_circulana and colateral values in a single pass.
+
+    The group is expanded once. The Circulana fee and the collateral yield, the only columns
+    that depend on the two parameters, are then computed for all scenarios at once along a
+    scenario axis broadcast over the flat (quota, month) arrays. Each scenario gives the
+    same values as a separate expandir_cotas run with those parameters; the sums can differ
+    in the last float digits.
+
+    Parameters:
+    df (pd.DataFrame): Group DataFrame, as returned by load_and_preprocess_grupo.
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+    tx_adm_circulana (list): Circulana administration fees; None is the first quota's fee.
+    colateral (list): Collateral fractions (see expandir_cotas); None is the default collateral.
+
+    Returns:
+    tuple: (df_quotas, df_totals). df_quotas has one row per scenario and quota with the
+    scenario number, its tx_adm_circulana and colateral (NaN for the default collateral),
+    the quota id and SWEEP_METRICS: costs summed over the quota's months, and the collateral
+    and its profits (in R$) at the quota's last month. df_totals sums the metrics of each
+    scenario over the group and counts its quotas.
+    """
+    last_rows = _latest_quota_rows(df)
+    today = pd.Timestamp.today()
+    default_tx = resolve_tx_adm_circulana(last_rows, None, today)
+    tx_values = np.array([default_tx if tx is None else tx for tx in tx_adm_circulana], dtype=np.float64)
+    colateral_values = list(colateral)
+    with stage('expand.columns') as timed:
+        consorcio, circulana = _expand_columns(last_rows, apys_df, default_tx, today)
+        timed.rows = len(consorcio['id'])
+
+    # Flat (quota, month) layout of the expanded rows, as in _expand_columns.
+    ids = consorcio['id']
+    n_rows = len(ids)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if n_rows else np.zeros(0, dtype=np.int64)
+    n_months = np.diff(np.r_[starts, n_rows])
+    n_quotas = len(starts)
+    quota = np.repeat(np.arange(n_quotas), n_months)
+    pos = np.arange(n_rows) - starts[quota]
+    last = starts + n_months - 1
+    max_len = int(n_months.max()) if n_quotas else 0
+
+    def per_quota_sum(values):
+        return np.add.reduceat(values, starts, axis=-1) if n_quotas else np.zeros(values.shape[:-1] + (0,))
+
+    total_cost_consorcio = per_quota_sum(consorcio['FC_paid']) + per_quota_sum(consorcio['TX_adm_monthly']) + per_quota_sum(consorcio['FR_paid']) + per_quota_sum(consorcio['seguro_paid'])
+    fc_paid = per_quota_sum(circulana['FC_paid'])
+
+    # Circulana fee of every scenario: one row of the (fee, row) grid per value.
+    with stage('expand.sweep_tx', rows=len(tx_values) * n_rows):
+        tx_monthly = tx_values[:, None] * circulana['vl_bem_corrigido'] / circulana['contracted_period']
+        invalid = ~np.isfinite(tx_monthly)
+        if invalid.any():
+            warnings.warn(f"Overflow detected in {int(invalid.sum())} rows of the tx_adm_circulana sweep")
+            tx_monthly = np.where(invalid, np.nan, tx_monthly)
+        tx_paid = per_quota_sum(tx_monthly)
+
+    # Collateral of every scenario, with the yield recurrence of _expand_columns per value.
+    with stage('expand.sweep_colateral', rows=len(colateral_values) * n_rows):
+        colateral_initial = np.zeros((len(colateral_values), n_quotas))
+        profits_colateral = np.zeros((len(colateral_values), n_quotas))
+        default = [i for i, value in enumerate(colateral_values) if value is None]
+        colateral_initial[default] = circulana['colateral_initial'][last]
+        profits_colateral[default] = circulana['profits_colateral'][last]
+        fractions = [i for i, value in enumerate(colateral_values) if value is not None]
+        contemplated = circulana['contemplated']
+        if fractions and contemplated.any():
+            fraction = np.array([colateral_values[i] for i in fractions], dtype=np.float64)[:, None]
+            month = circulana['month']
+            rows = np.flatnonzero(contemplated)
+            rows_quota = quota[rows]
+            is_contemplated_q = contemplated[last]
+            first_contemplated = (starts + n_months - np.bincount(quota, weights=contemplated, minlength=n_quotas).astype(np.int64))[is_contemplated_q]
+            bem_contemplacao = np.zeros(n_quotas)
+            bem_contemplacao[is_contemplated_q] = circulana['vl_bem'][first_contemplated]
+            bem_contemplacao_dolar = np.zeros(n_quotas)
+            bem_contemplacao_dolar[is_contemplated_q] = convert_currency_many(month[first_contemplated], bem_contemplacao[is_contemplated_q])
+
+            valor_colateral = fraction * bem_contemplacao_dolar[rows_quota]
+            profits_dolar = np.zeros((len(fractions), n_rows))
+            profits_dolar[:, rows] = calcular_rentabilidade_mes_many(valor_colateral, month[rows], apys_df=apys_df) - valor_colateral
+            profits_dolar = _segment_accumulate(np.add, profits_dolar, quota, pos, n_quotas, max_len)[:, last]
+            profits_brl = np.zeros((len(fractions), n_quotas))
+            profits_brl[:, is_contemplated_q] = convert_currency_many(month[last[is_contemplated_q]], profits_dolar[:, is_contemplated_q], to_currency='brl')
+            profits_colateral[fractions] = profits_brl
+            colateral_initial[fractions] = np.where(is_contemplated_q, fraction * bem_contemplacao, 0.0)
+
+    scenarios = list(itertools.product(range(len(tx_values)), range(len(colateral_values))))
+    tx_index = np.repeat([t for t, _ in scenarios], n_quotas)
+    colateral_index = np.repeat([c for _, c in scenarios], n_quotas)
+    quota_index = np.tile(np.arange(n_quotas), len(scenarios))
+    df_quotas = pd.DataFrame({
+        'scenario': np.repeat(np.arange(len(scenarios)), n_quotas),
+        'tx_adm_circulana': tx_values[tx_index],
+        'colateral': np.array([np.nan if value is None else value for value in colateral_values], dtype=np.float64)[colateral_index],
+        'id': ids[starts][quota_index],
+        'total_cost_consorcio': total_cost_consorcio[quota_index],
+        'total_cost_circulana': fc_paid[quota_index] + tx_paid[tx_index, quota_index],
+        'TX_adm_paid_circulana': tx_paid[tx_index, quota_index],
+        'colateral_initial': colateral_initial[colateral_index, quota_index],
+        'profits_colateral': profits_colateral[colateral_index, quota_index],
+    })
+    df_totals = df_quotas.groupby(['scenario', 'tx_adm_circulana', 'colateral'], dropna=False, sort=False)[SWEEP_METRICS].sum()
+    df_totals['n_quotas'] = n_quotas
+    return df_quotas, df_totals.reset_index()
@@ -0,0 +1,388 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from instrumentation import instrumented, stage
+from reference_data import file_digest, file_signature
+
+# Directory holding every input file of the simulation (defaults to the working directory,
+# where the app has always looked for them).
+DATA_DIR = os.environ.get('SIMULACAO_DATA_DIR', '.')
+# When set, files missing from DATA_DIR are served from this folder instead of Google Drive.
+OFFLINE_DIR = os.environ.get('SIMULACAO_OFFLINE_DIR')
+DRIVE_FOLDER = 'Base_simulacao'
+MANIFEST_FILE = 'data_manifest.json'
+SCOPES = ["https://www.googleapis.com/auth/drive"]
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = 8
+
+# Guards the manifest; download threads never take it.
+_lock = threading.RLock()
+# Guards the Drive credentials and the folder id cache.
+_service_lock = threading.Lock()
+_thread_local = threading.local()
+_credentials = None
+_offline_service = None
+_folder_ids = {}
+# name -> size of the files already checked against the manifest in this process.
+_resolved = {}
+# (path, mtime_ns, size) -> sha256 of the files hashed in this process.
+_checksums = {}
+
+
+def load_credentials_info():
+    """Reads and validates the service account JSON from the 'CREDENTIALS' environment variable."""
+    credentials_data = os.environ.get('CREDENTIALS')
+    if not credentials_data:
+        raise ValueError("A variável de ambiente 'CREDENTIALS' está vazia ou não foi definida.")
+    try:
+        return json.loads(credentials_data)
+    except json.JSONDecodeError:
+        raise ValueError("O conteúdo da variável de ambiente 'CREDENTIALS' não é um JSON válido.")
+
+
+class LocalHttpError(Exception):
+    """Mimics googleapiclient.errors.HttpError, with the HTTP status in resp.status."""
+
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.resp = type('Response', (), {'status': status})()
+
+
+def _http_status(error):
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+
+class _LocalRequest:
+    """Mimics an executable googleapiclient request."""
+
+    def __init__(self, execute):
+        self.headers = {}
+        self._execute = execute
+
+    def execute(self):
+        return self._execute(self.headers)
+
+
+class LocalDriveService:
+    """
+    Stand-in for the part of the Drive v3 client used here, serving a local folder as the
+    Drive folder `folder_name`. File ids are the file names.
+
+    Used for the offline mode and to exercise the download path without network access.
+    """
+
+    def __init__(self, folder, folder_name=DRIVE_FOLDER):
+        self.folder = folder
+        self.folder_name = folder_name
+
+    def files(self):
+        return self
+
+    def list(self, q, fields=None, pageSize=None, pageToken=None):
+        names = [name.replace("\\'", "'") for name in re.findall(r"name='((?:[^'\\]|\\.)*)'", q)]
+        if "mimeType='application/vnd.google-apps.folder'" in q:
+            files = [{'id': self.folder_name, 'name': self.folder_name}] if self.folder_name in names else []
+        else:
+            files = []
+            for name in names:
+                path = os.path.join(self.folder, name)
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        md5 = hashlib.md5(f.read()).hexdigest()
+                    files.append({'id': name, 'name': name, 'size': str(os.path.getsize(path)), 'md5Checksum': md5})
+        return _LocalRequest(lambda headers: {'files': files})
+
+    def get_media(self, fileId):
+        def execute(headers):
+            path = os.path.join(self.folder, fileId)
+            with open(path, 'rb') as f:
+                match = re.fullmatch(r'bytes=(\d+)-(\d*)', headers.get('Range', ''))
+                if not match:
+                    return f.read()
+                first, last = int(match.group(1)), match.group(2)
+                # Like Drive, a range starting at or after the end of the file is not satisfiable.
+                if first >= os.path.getsize(path):
+                    raise LocalHttpError(416)
+                f.seek(first)
+                return f.read(int(last) - first + 1) if last else f.read()
+        return _LocalRequest(execute)
+
+
+def get_drive_service():
+    """
+    Returns a Drive client for the calling thread, authenticating on first use.
+
+    The googleapiclient client is not thread-safe, so every thread gets its own (sharing the
+    credentials). In offline mode a LocalDriveService over SIMULACAO_OFFLINE_DIR is returned.
+    """
+    global _credentials, _offline_service
+    if OFFLINE_DIR:
+        with _service_lock:
+            if _offline_service is None:
+                _offline_service = LocalDriveService(OFFLINE_DIR)
+            return _offline_service
+    drive_service = getattr(_thread_local, 'drive_service', None)
+    if drive_service is None:
+        from googleapiclient.discovery import build
+        with _service_lock:
+            if _credentials is None:
+                from google.oauth2 import service_account
+                _credentials = service_account.Credentials.from_service_account_info(load_credentials_info(), scopes=SCOPES)
+        drive_service = _thread_local.drive_service = build('drive', 'v3', credentials=_credentials, cache_discovery=False)
+    return drive_service
+
+
+def _quote(value):
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def get_folder_id(drive_service, folder_name):
+    query = f"name='{_quote(folder_name)}' and mimeType='application/vnd.google-apps.folder'"
+    results = drive_service.files().list(
+        q=query,
+        fields="files(id, name)"
+    ).execute()
+    folders = results.get('files', [])
+    if not folders:
+        print(f"Pasta '{folder_name}' não encontrada.")
+        return None
+    return folders[0]['id']
+
+
+def drive_folder_id(drive_service, folder_name=DRIVE_FOLDER):
+    """get_folder_id, looked up once per process."""
+    with _service_lock:
+        if folder_name in _folder_ids:
+            return _folder_ids[folder_name]
+    folder_id = get_folder_id(drive_service, folder_name)
+    if folder_id is None:
+        raise FileNotFoundError(f"Pasta '{folder_name}' não encontrada no Google Drive.")
+    with _service_lock:
+        _folder_ids[folder_name] = folder_id
+    return folder_id
+
+
+def list_drive_files(drive_service, folder_id, file_names):
+    """
+    Lists the given files of a Drive folder in a single query.
+
+    Returns:
+    dict: file name -> {'id', 'name', 'size', 'md5Checksum'} for the files found.
+    """
+    if not file_names:
+        return {}
+    names = ' or '.join(f"name='{_quote(name)}'" for name in file_names)
+    query = f"'{folder_id}' in parents and trashed=false and ({names})"
+    listing, page_token = {}, None
+    while True:
+        results = drive_service.files().list(
+            q=query,
+            fields="nextPageToken, files(id, name, size, md5Checksum)",
+            pageSize=1000,
+            pageToken=page_token
+        ).execute()
+        for item in results.get('files', []):
+            listing.setdefault(item['name'], item)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return listing
+
+
+def _download_to(drive_service, item, part_path, offset, chunk_size):
+    """Downloads item into part_path from byte offset on, one ranged request per chunk."""
+    total = int(item['size']) if 'size' in item else None
+    with open(part_path, 'ab' if offset else 'wb') as fh:
+        fh.truncate(offset)
+        while total is None or offset < total:
+            request = drive_service.files().get_media(fileId=item['id'])
+            request.headers['Range'] = f'bytes={offset}-{offset + chunk_size - 1}'
+            try:
+                content = request.execute()
+            except Exception as error:
+                # Without the size, a file ending on a chunk boundary ends with a 416 at EOF.
+                if total is None and _http_status(error) == 416:
+                    break
+                raise
+            if not content:
+                break
+            fh.write(content)
+            offset += len(content)
+            if len(content) < chunk_size:
+                break
+
+
+def _md5_matches(item, path):
+    if 'md5Checksum' not in item:
+        return True
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest() == item['md5Checksum']
+
+
+@instrumented('drive.download')
+def download_drive_file(item, destination, chunk_size=None):
+    """
+    Downloads a listed Drive file to destination.
+
+    Bytes go to destination + '.part', which is renamed over destination once complete (and
+    its MD5 matches), so readers never see a partial file. A .part left by an interrupted
+    download is resumed from where it stopped; if the resumed file does not match, it is
+    downloaded again from the start.
+    """
+    drive_service = get_drive_service()
+    chunk_size = chunk_size or DOWNLOAD_CHUNK_SIZE
+    part_path = destination + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if 'size' in item and offset > int(item['size']):
+        offset = 0
+    _download_to(drive_service, item, part_path, offset, chunk_size)
+    if offset and not _md5_matches(item, part_path):
+        _download_to(drive_service, item, part_path, 0, chunk_size)
+    if not _md5_matches(item, part_path):
+        os.remove(part_path)
+        raise IOError(f"Download de '{item['name']}' corrompido (MD5 diferente do Drive).")
+    os.replace(part_path, destination)
+
+
+def data_path(name):
+    """Path of a file (input or derived, e.g. an artifact) inside the data directory."""
+    return os.path.join(DATA_DIR, name)
+
+
+def _manifest_name(name):
+    """Name of a file relative to the data directory, so that resolved paths resolve to themselves."""
+    if os.path.isabs(name) or name.startswith(os.path.join(DATA_DIR, '')):
+        relative = os.path.relpath(name, DATA_DIR)
+        if not relative.startswith(os.pardir):
+            return relative
+    return name
+
+
+def read_manifest():
+    """Returns the manifest of the data directory: {name: {size, sha256, source, fetched_at}}."""
+    manifest_path = data_path(MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest):
+    manifest_path = data_path(MANIFEST_FILE)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _record(manifest, name, path, source):
+    manifest[name] = {
+        'size': os.path.getsize(path),
+        'sha256': file_digest(path),
+        'source': source,
+        'fetched_at': pd.Timestamp.now().isoformat(),
+    }
+    _write_manifest(manifest)
+
+
+def _source():
+    return f'offline:{OFFLINE_DIR}' if OFFLINE_DIR else f'drive:{DRIVE_FOLDER}'
+
+
+def prefetch_data_files(names, max_workers=DOWNLOAD_WORKERS):
+    """
+    Makes sure every file in names is in the data directory, downloading the missing ones.
+
+    The Drive folder is looked up once, the missing files are listed in a single query and
+    downloaded concurrently, so a cold start takes about as long as the largest file.
+
+    Parameters:
+    names (list): File names, e.g. ['cdi.csv', 'FIPE-GRUPO-655-FIPE.csv'].
+    max_workers (int): Maximum number of concurrent downloads.
+
+    Returns:
+    list: Paths of the files inside the data directory, in the order of names.
+    """
+    names = list(dict.fromkeys(_manifest_name(name) for name in names))
+    with _lock:
+        missing = [name for name in names if not os.path.exists(data_path(name))]
+        if missing:
+            with stage('drive.prefetch', rows=len(missing)):
+                drive_service = get_drive_service()
+                listing = list_drive_files(drive_service, drive_folder_id(drive_service), [os.path.basename(name) for name in missing])
+                not_found = [name for name in missing if os.path.basename(name) not in listing]
+                if not_found:
+                    raise FileNotFoundError(f"Arquivos não encontrados na pasta '{DRIVE_FOLDER}': {', '.join(not_found)}.")
+                for name in missing:
+                    os.makedirs(os.path.dirname(data_path(name)) or '.', exist_ok=True)
+                with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as pool:
+                    futures = {
+                        pool.submit(download_drive_file, listing[os.path.basename(name)], data_path(name)): name
+                        for name in missing
+                    }
+                    for future in as_completed(futures):
+                        future.result()
+                        name = futures[future]
+                        _record(read_manifest(), name, data_path(name), _source())
+        return [resolve_data_file(name) for name in names]
+
+
+def resolve_data_file(name):
+    """
+    Returns the local path of an input file, fetching it on a cache miss.
+
+    Files already in the data directory are used as they are (and recorded in the manifest the
+    first time they are seen). Missing files are fetched with prefetch_data_files, from the
+    offline folder when SIMULACAO_OFFLINE_DIR is set, otherwise from the Drive folder; the
+    Drive client is only created at that point.
+
+    Parameters:
+    name (str): File name, e.g. 'cdi.csv'.
+
+    Returns:
+    str: Path of the file inside the data directory.
+    """
+    name = _manifest_name(name)
+    path = data_path(name)
+    if os.path.exists(path) and _resolved.get(name) == os.path.getsize(path):
+        return path
+    with _lock:
+        manifest = read_manifest()
+        if os.path.exists(path):
+            entry = manifest.get(name)
+            if entry is None or entry['size'] != os.path.getsize(path):
+                _record(manifest, name, path, entry['source'] if entry else 'local')
+            _resolved[name] = os.path.getsize(path)
+            return path
+
+        return prefetch_data_files([name])[0]
+
+
+def data_file_checksum(name):
+    """Returns the SHA-256 of an input file, fetching it if needed; only rehashed when the file changes."""
+    path = resolve_data_file(name)
+    key = (path, *file_signature(path))
+    if key not in _checksums:
+        _checksums[key] = file_digest(path)
+    return _checksums[key]
+
+
+def verify_data_files():
+    """
+    Recomputes the checksum of every file in the manifest.
+
+    Returns:
+    list: Names of the files that are missing or whose content no longer matches the manifest.
+    """
+    mismatches = []
+    for name, entry in read_manifest().items():
+        path = data_path(name)
+        if not os.path.exists(path) or file_digest(path) != entry['sha256']:
+            mismatches.append(name)
+    return mismatches
@@ -1,28 +1,110 @@
+import io
+import threading
+from collections import OrderedDict
 import streamlit as st
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
+from artifacts import QuotaIndex
+from cost_cube import build_cost_cube, select_cells
+from instrumentation import instrumented
+from load_functions import NO_MONTH, month_labels
 
-def compare_consorcio_circulana(df_expanded_consorcio, df_expanded_circulana, selected_id=None, tx_adm_filter=None, month_contemplated=None, month_canceled=None):
-    # Filter data based on the selected criteria
-    if selected_id:
-        df_expanded_consorcio = df_expanded_consorcio[df_expanded_consorcio['id'] == selected_id]
-        df_expanded_circulana = df_expanded_circulana[df_expanded_circulana['id'] == selected_id]
-    
-    if tx_adm_filter:
-        df_expanded_consorcio = df_expanded_consorcio[df_expanded_consorcio['TX_adm_%'] == tx_adm_filter]
-        df_expanded_circulana = df_expanded_circulana[df_expanded_circulana['id'].isin(df_expanded_consorcio['id'])]
-    
+# Rendered quota comparisons by (scenario, quota id), least recently used first.
+FIGURE_CACHE_SIZE = 64
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+
+def _get_cached_figures(cache_key, quota_id):
+    with _figure_cache_lock:
+        cached = _figure_cache.get((cache_key, quota_id))
+        if cached is not None:
+            _figure_cache.move_to_end((cache_key, quota_id))
+        return cached
+
+def _put_cached_figures(cache_key, quota_id, cached):
+    with _figure_cache_lock:
+        _figure_cache[(cache_key, quota_id)] = cached
+        _figure_cache.move_to_end((cache_key, quota_id))
+        while len(_figure_cache) > FIGURE_CACHE_SIZE:
+            _figure_cache.popitem(last=False)
+
+def clear_figure_cache():
+    with _figure_cache_lock:
+        _figure_cache.clear()
+
+# Streamlit downsizes images wider than its content area (1460 px) on every display, so
+# figures are rendered just below that width and cached PNGs are sent as they are.
+FIGURE_WIDTH_PX = 1400
+
+def _figure_png(fig):
+    """PNG bytes of a figure, at a resolution Streamlit displays without resizing."""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight', dpi=FIGURE_WIDTH_PX / fig.get_figwidth())
+    return buffer.getvalue()
+
+def add_quota_summary_columns(df_consorcio, df_circulana):
+    """
+    Adds the monthly costs, totals paid and amounts received shown by plot_quota_comparison.
+
+    Computed for every quota at once; frames must be sorted by id, and totals are
+    cumulated within each quota.
+
+    Returns:
+    tuple: (df_consorcio, df_circulana), new frames with the added columns.
+    """
+    df_consorcio = df_consorcio.copy()
+    df_circulana = df_circulana.copy()
+    contemplated = df_consorcio["contemplated"].to_numpy(dtype=bool)
+
+    df_consorcio["monthly_cost"] = df_consorcio["FC_paid"] + df_consorcio["TX_adm_monthly"] + df_consorcio["FR_paid_monthly"] + df_consorcio["seguro_paid"]
+    df_circulana["monthly_cost"] = df_circulana["FC_paid"] + df_circulana["TX_adm_monthly"]
+
+    df_consorcio["amount_received"] = np.where(contemplated, df_consorcio["consorcio_w_profits"], df_consorcio["vl_bem"])
+    df_circulana["amount_received_colateral"] = np.where(contemplated, df_circulana["bem_contemplacao_dolar_colateral"], df_circulana["vl_bem"]) + df_circulana["profits_colateral"]
+    df_circulana["amount_received_bem"] = np.where(contemplated, df_circulana["bem_contemplacao_dolar"], df_circulana["vl_bem"]) + df_circulana["profits_bem"]
+
+    by_quota = df_circulana.groupby("id", sort=False)
+    df_circulana["total_paid"] = by_quota["FC_paid"].cumsum() + by_quota["TX_adm_monthly"].cumsum()
+    df_circulana["total_paid_with_colateral"] = df_circulana["total_paid"] + df_circulana["colateral_initial"]
+    df_consorcio["total_paid"] = df_consorcio.groupby("id", sort=False)["monthly_cost"].cumsum()
+    return df_consorcio, df_circulana
+
+def quota_rows(df, quota_id, index=None):
+    """
+    Rows of one quota of a frame sorted by id.
+
+    Parameters:
+    df (pd.DataFrame): Frame sorted by id (expanded frames and the group are).
+    quota_id (int): Quota id.
+    index (QuotaIndex): Index of df's ids; built from df when not given.
+    """
+    index = index if index is not None else QuotaIndex.from_frame(df)
+    if quota_id not in index:
+        return df.iloc[:0]
+    return df.iloc[index.slice(quota_id)]
+
+@instrumented('render.compare_consorcio_circulana')
+def compare_consorcio_circulana(cube, tx_adm_filter=None, month_contemplated=None, month_canceled=None):
+    """
+    Displays the total cost of both products over the group, from the cost cube.
+
+    Parameters:
+    cube (pd.DataFrame): Cost cube of the scenario (see cost_cube.build_cost_cube).
+    tx_adm_filter (float): Only quotas with this administration fee, in percent.
+    month_contemplated (str): Only the costs of this month, 'YYYY-MM'.
+    month_canceled (str): Only the costs of this month, 'YYYY-MM'.
+    """
+    # Filter the cells of the cube based on the selected criteria
+    cells = select_cells(cube, tx_adm_filter=tx_adm_filter)
     if month_contemplated:
-        df_expanded_consorcio = df_expanded_consorcio[df_expanded_consorcio['month'] == month_contemplated]
-        df_expanded_circulana = df_expanded_circulana[df_expanded_circulana['id'].isin(df_expanded_consorcio['id'])]
-    
+        cells = select_cells(cells, month=month_contemplated)
     if month_canceled:
-        df_expanded_consorcio = df_expanded_consorcio[df_expanded_consorcio['month'] == month_canceled]
-        df_expanded_circulana = df_expanded_circulana[df_expanded_circulana['id'].isin(df_expanded_consorcio['id'])]
-    
+        cells = select_cells(cells, month=month_canceled)
+
     # Calculate total costs and returns
-    total_cost_consorcio = df_expanded_consorcio['FC_paid'].sum() + df_expanded_consorcio['TX_adm_monthly'].sum() + df_expanded_consorcio['FR_paid'].sum() + df_expanded_consorcio['seguro_paid'].sum()
-    total_cost_circulana = df_expanded_circulana['FC_paid'].sum() + df_expanded_circulana['TX_adm_monthly'].sum()
+    total_cost_consorcio = cells['consorcio_FC_paid'].sum() + cells['consorcio_TX_adm_monthly'].sum() + cells['consorcio_FR_paid'].sum() + cells['consorcio_seguro_paid'].sum()
+    total_cost_circulana = cells['circulana_FC_paid'].sum() + cells['circulana_TX_adm_monthly'].sum()
     
     # Display total costs using Streamlit
     st.metric("Consórcio", f"R$ {total_cost_consorcio:,.2f}")
@@ -39,26 +121,37 @@ def compare_consorcio_circulana(df_expanded_consorcio, df_expanded_circulana, se
     # Display the plot in Streamlit
     st.pyplot(fig)
 
-def display_visualizations(df_expanded_consorcio, df_grupo):
+@instrumented('render.display_visualizations')
+def display_visualizations(df_expanded_consorcio, df_grupo, cube=None):
     """
     Displays visualizations and calculations for the consorcio data in a Streamlit app.
     
     Parameters:
     df_expanded_consorcio (pd.DataFrame): DataFrame containing expanded consorcio data.
     df_grupo (pd.DataFrame): DataFrame containing grupo data.
+    cube (pd.DataFrame): Cost cube of the scenario; built from the frames when not given.
     """
+    if cube is None:
+        # Only the consorcio sums are shown, so the consorcio frame also fills the circulana ones.
+        cube = build_cost_cube(df_expanded_consorcio, df_expanded_consorcio, df_grupo)
+    columns = ['consorcio_FC_paid', 'consorcio_TX_adm_paid', 'consorcio_FR_paid', 'consorcio_seguro_paid']
+    # Totals cover every row; the time series, as before, only the rows with a month.
+    totals = cube[columns].sum()
+    monthly = cube.groupby('month')[columns].sum()
+
     # Total FC, FR, and Adm Taxes
-    total_fc = df_expanded_consorcio["FC_paid"].sum()
-    total_fr = df_expanded_consorcio["FR_paid"].sum()
-    total_tx_adm = df_expanded_consorcio["TX_adm_paid"].sum()
+    total_fc = totals["consorcio_FC_paid"]
+    total_fr = totals["consorcio_FR_paid"]
+    total_tx_adm = totals["consorcio_TX_adm_paid"]
 
     st.write(f"Total FC: R$ {total_fc:,.2f}")
     st.write(f"Total FR: R$ {total_fr:,.2f}")
     st.write(f"Total Adm Taxes: R$ {total_tx_adm:,.2f}")
 
     # Per Quota Analysis
-    selected_id = df_expanded_consorcio["id"].unique()[0]  # Select the first quota ID for demonstration
-    quota_df = df_expanded_consorcio[df_expanded_consorcio["id"] == selected_id]
+    index = QuotaIndex.from_frame(df_expanded_consorcio)
+    selected_id = index.ids[0]  # Select the first quota ID for demonstration
+    quota_df = quota_rows(df_expanded_consorcio, selected_id, index)
 
     st.write(f"### Detalhes da Cota {selected_id}")
     st.write(quota_df)
@@ -66,53 +159,48 @@ def display_visualizations(df_expanded_consorcio, df_grupo):
     # Plot tx_adm_paid for all quotas
     st.write("### TX Adm Paid Over Time")
     plt.figure(figsize=(14, 8))
-    df_expanded_consorcio.groupby("month")["TX_adm_paid"].sum().plot()
+    monthly["consorcio_TX_adm_paid"].plot()
     plt.xlabel("Month")
     plt.ylabel("TX Adm Paid")
     plt.title("TX Adm Paid Over Time")
     st.pyplot(plt)
 
-    st.write(f"O total da taxa de adm arrecadado no grupo todo foi: R$ {df_expanded_consorcio['TX_adm_paid'].sum():,.2f}")
+    st.write(f"O total da taxa de adm arrecadado no grupo todo foi: R$ {total_tx_adm:,.2f}")
 
     # Canceled Quotas Analysis
-    df_canceled = df_grupo[df_grupo['dt_canc'].notna()]
-    unique_ids_with_dt_canc = df_canceled['id'].unique()
-    num_unique_ids_with_dt_canc = len(unique_ids_with_dt_canc)
+    canc_months = df_grupo['dt_canc_month'].to_numpy()
+    canc_months = canc_months[canc_months != NO_MONTH]
 
-    st.write(f"Tem {num_unique_ids_with_dt_canc} quotas canceladas no grupo")
-    st.write(f"Tem {len(df_grupo['id'].unique())} quotas no grupo")
+    st.write(f"Tem {len(canc_months)} quotas canceladas no grupo")
+    st.write(f"Tem {len(df_grupo)} quotas no grupo")
 
     st.write("### Quantity of Canceled Quotas per Month")
     plt.figure(figsize=(14, 8))
-    df_canceled['dt_canc'] = pd.to_datetime(df_canceled['dt_canc'])
-    df_canceled['month'] = df_canceled['dt_canc'].dt.to_period('M')
-    df_canceled['month'].value_counts().sort_index().plot(kind='bar')
+    codes, counts = np.unique(canc_months, return_counts=True)
+    pd.Series(counts, index=month_labels(codes)).plot(kind='bar')
     plt.xlabel("Month")
     plt.ylabel("Quantity of Canceled Quotas")
     plt.title("Quantity of Canceled Quotas per Month")
     st.pyplot(plt)
 
     # Total Paid Analysis
-    df_expanded_consorcio['total_paid'] = (
-        df_expanded_consorcio['FC_paid'] + df_expanded_consorcio['TX_adm_paid'] +
-        df_expanded_consorcio['FR_paid'] + df_expanded_consorcio['seguro_paid']
-    )
+    total_paid = monthly['consorcio_FC_paid'] + monthly['consorcio_TX_adm_paid'] + monthly['consorcio_FR_paid'] + monthly['consorcio_seguro_paid']
 
     st.write("### Total Paid Over Time")
     plt.figure(figsize=(14, 8))
-    df_expanded_consorcio.groupby('month')['total_paid'].sum().plot()
+    total_paid.plot()
     plt.xlabel("Month")
     plt.ylabel("Total Paid")
     plt.title("Total Paid Over Time")
     st.pyplot(plt)
 
-    st.write(f"O total pago no grupo todo foi: R$ {df_expanded_consorcio['total_paid'].sum():,.2f}")
+    st.write(f"O total pago no grupo todo foi: R$ {totals.sum():,.2f}")
 
     # Quotas Sold Analysis
     st.write("### Number of Quotas Sold per Month")
-    df_grupo['dt_venda'] = pd.to_datetime(df_grupo['dt_venda'])
-    df_grupo['month_sold'] = df_grupo['dt_venda'].dt.to_period('M')
-    quotas_sold_by_month = df_grupo['month_sold'].value_counts().sort_index()
+    sold_months = df_grupo['dt_venda_month'].to_numpy()
+    codes, counts = np.unique(sold_months[sold_months != NO_MONTH], return_counts=True)
+    quotas_sold_by_month = pd.Series(counts, index=month_labels(codes))
 
     plt.figure(figsize=(14, 8))
     quotas_sold_by_month.plot(kind='bar')
@@ -121,49 +209,50 @@ def display_visualizations(df_expanded_consorcio, df_grupo):
     plt.title("Number of Quotas Sold per Month")
     st.pyplot(plt)
 
-def plot_quota_comparison(df_consorcio, df_circulana, quota_id):
+@instrumented('render.plot_quota_comparison')
+def plot_quota_comparison(df_consorcio, df_circulana, quota_id, index=None, cache_key=None):
     """
     Plots the costs and amounts received for the selected quota over time.
 
     Parameters:
-    df_consorcio (pd.DataFrame): DataFrame containing Consórcio data.
-    df_circulana (pd.DataFrame): DataFrame containing Circulana data.
+    df_consorcio (pd.DataFrame): DataFrame containing Consórcio data, sorted by id.
+    df_circulana (pd.DataFrame): DataFrame containing Circulana data, with the same rows as df_consorcio.
     quota_id (int or str): The quota ID to filter the data.
+    index (QuotaIndex): Index of the frames' ids; built from df_consorcio when not given.
+    cache_key (str): Identifies the scenario of the frames (e.g. its artifact path). When
+        given, the rendered figures and summary are kept in an LRU cache by (cache_key, quota_id)
+        and later calls only check that the quota is in the frames before showing them.
     """
-    # Filter and make copies of the data
-    consorcio_q = df_consorcio[df_consorcio["id"] == quota_id].copy()
-    circulana_q = df_circulana[df_circulana["id"] == quota_id].copy()
+    # The quota must be in the frames passed in, even when its figures are cached.
+    index = index if index is not None else QuotaIndex.from_frame(df_consorcio)
+    if quota_id not in index:
+        raise ValueError("Quota ID not found in one of the datasets.")
+    cached = _get_cached_figures(cache_key, quota_id) if cache_key is not None else None
+    if cached is None:
+        cached = _render_quota_comparison(df_consorcio, df_circulana, quota_id, index)
+        if cache_key is not None:
+            _put_cached_figures(cache_key, quota_id, cached)
+    figures, summary_df = cached
+    for png in figures:
+        st.image(png, use_container_width=True)
+    st.header("Resumo da comparação")
+    st.write(summary_df)
+
+def _render_quota_comparison(df_consorcio, df_circulana, quota_id, index=None):
+    """Draws the figures of plot_quota_comparison; returns their PNG bytes and the summary table."""
+    # Slice and make copies of the data
+    index = index if index is not None else QuotaIndex.from_frame(df_consorcio)
+    consorcio_q = quota_rows(df_consorcio, quota_id, index).copy()
+    circulana_q = quota_rows(df_circulana, quota_id, index).copy()
 
     if consorcio_q.empty or circulana_q.empty:
         raise ValueError("Quota ID not found in one of the datasets.")
 
-    # Calculate monthly costs
-    consorcio_q.loc[:, "monthly_cost"] = (
-        consorcio_q["FC_paid"] + consorcio_q["TX_adm_monthly"] + 
-        consorcio_q["FR_paid_monthly"] + consorcio_q["seguro_paid"]
-    )
-    circulana_q.loc[:, "monthly_cost"] = circulana_q["FC_paid"] + circulana_q["TX_adm_monthly"]
-    
-    # Calculate amount received
-    consorcio_q.loc[:, "amount_received"] = consorcio_q.apply(
-        lambda row: row["vl_bem"] if not row["contemplated"] else row["consorcio_w_profits"], axis=1
-    )
-    circulana_q.loc[:, "amount_received_colateral"] = circulana_q.apply(
-        lambda row: (row["bem_contemplacao_dolar_colateral"] + row["profits_colateral"]) if row["contemplated"] 
-                    else (row["vl_bem"] + row["profits_colateral"]),
-        axis=1
-    )
-    circulana_q.loc[:, "amount_received_bem"] = circulana_q.apply(
-        lambda row: (row["bem_contemplacao_dolar"] + row["profits_bem"]) if row["contemplated"] 
-                    else (row["vl_bem"] + row["profits_bem"]),
-        axis=1
-    )
-
-    # Calculate total amount paid (with and without collateral)
-    circulana_q.loc[:, "total_paid"] = circulana_q["FC_paid"].cumsum() + circulana_q["TX_adm_monthly"].cumsum()
-    circulana_q.loc[:, "total_paid_with_colateral"] = circulana_q["total_paid"] + circulana_q["colateral_initial"]
-    consorcio_q.loc[:, "total_paid"] = consorcio_q['monthly_cost'].cumsum()
+    # Costs and amounts received, unless the frames already have them (see add_quota_summary_columns)
+    if "amount_received" not in consorcio_q.columns or "amount_received_bem" not in circulana_q.columns:
+        consorcio_q, circulana_q = add_quota_summary_columns(consorcio_q, circulana_q)
 
+    figures = []
     # Plot monthly costs
     plt.figure(figsize=(12, 5))
     plt.plot(consorcio_q["month"], consorcio_q["monthly_cost"], label="Custo Mensal Consórcio", marker="o")
@@ -173,8 +262,8 @@ def plot_quota_comparison(df_consorcio, df_circulana, quota_id):
     plt.title(f"Evolução dos gastos com correção do bem")
     plt.legend()
     plt.grid()
-    st.pyplot(plt.gcf())
-    plt.clf()
+    figures.append(_figure_png(plt.gcf()))
+    plt.close()
 
     # Plot tx_adm_paid
     plt.figure(figsize=(12, 5))
@@ -199,8 +288,8 @@ def plot_quota_comparison(df_consorcio, df_circulana, quota_id):
     plt.title(f"Valor total pago")
     plt.legend()
     plt.grid()
-    st.pyplot(plt.gcf())
-    plt.clf()
+    figures.append(_figure_png(plt.gcf()))
+    plt.close()
 
     # Plot amount received
     plt.figure(figsize=(12, 5))
@@ -217,8 +306,8 @@ def plot_quota_comparison(df_consorcio, df_circulana, quota_id):
     plt.title(f"Contemplação não resgatada")
     plt.legend()
     plt.grid()
-    st.pyplot(plt.gcf())
-    plt.clf()
+    figures.append(_figure_png(plt.gcf()))
+    plt.close()
 
     # Plot amount received
     plt.figure(figsize=(12, 5))
@@ -237,12 +326,11 @@ def plot_quota_comparison(df_consorcio, df_circulana, quota_id):
     plt.title(f"Contemplação com adição de collateral")
     plt.legend()
     plt.grid()
-    st.pyplot(plt.gcf())
-    plt.clf()
+    figures.append(_figure_png(plt.gcf()))
+    plt.close()
 
 
     # Create a summary dictionary with categories as columns
-    st.header("Resumo da comparação")
     summary_data = {
         "Produto": ["Consórcio (R$)", "Circulana (R$)"],
         "TX_adm": [
@@ -291,6 +379,6 @@ def plot_quota_comparison(df_consorcio, df_circulana, quota_id):
         ]
     }
 
-    # Convert to DataFrame and display the summary in Streamlit
+    # Convert to DataFrame; it is displayed by plot_quota_comparison
     summary_df = pd.DataFrame(summary_data)
-    st.write(summary_df)
+    return figures, summary_df
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+from load_functions import GRUPO_MONTH_COLUMNS, NO_MONTH, month_labels
+
+
+class MonthFilterIndex:
+    """
+    Inverted indexes from month code to quota ids, for the date filters of the app.
+
+    Built once per group from the month code columns of load_and_preprocess_grupo. Any
+    combination of creation (dt_venda), cancellation (dt_canc) and contemplation
+    (dt_contemplacao) months is answered by intersecting the id sets of the chosen months,
+    so changing a filter never touches the group frame.
+    """
+
+    def __init__(self, df_grupo):
+        self.all_ids = frozenset(df_grupo['id'].tolist())
+        self._postings = {}
+        for col, month_col in GRUPO_MONTH_COLUMNS.items():
+            codes = df_grupo[month_col].to_numpy()
+            present = codes != NO_MONTH
+            ids_by_code = pd.Series(df_grupo['id'].to_numpy()[present]).groupby(codes[present]).agg(frozenset)
+            self._postings[col] = dict(zip(ids_by_code.index.tolist(), ids_by_code.tolist()))
+
+    def months(self, col):
+        """Sorted 'YYYY-MM' labels of the months present in a date column."""
+        return month_labels(sorted(self._postings[col])).tolist()
+
+    def ids(self, **months):
+        """
+        Returns the ids of the quotas matching every given month.
+
+        Parameters:
+        months: Date column to month label, e.g. dt_venda='2023-05'. None or "All" does not filter.
+
+        Returns:
+        np.ndarray: Sorted quota ids.
+        """
+        postings = []
+        for col, label in months.items():
+            if label is None or label == "All":
+                continue
+            code = int(np.datetime64(label, 'M').astype(np.int64))
+            postings.append(self._postings[col].get(code, frozenset()))
+        if not postings:
+            matched = self.all_ids
+        else:
+            postings.sort(key=len)
+            matched = postings[0].intersection(*postings[1:])
+        return np.sort(np.fromiter(matched, dtype=np.int64, count=len(matched)))
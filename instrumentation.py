@@ -0,0 +1,161 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+# Timings are only collected when enabled (SIMULACAO_INSTRUMENTATION=1 or enable()); when
+# disabled stage() and instrumented functions do nothing but check this flag. The flag and
+# the stats are process-wide, unless a Session is in use in the current thread.
+_enabled = os.environ.get('SIMULACAO_INSTRUMENTATION', '') not in ('', '0')
+_lock = threading.Lock()
+_stats = {}
+_session = contextvars.ContextVar('instrumentation_session', default=None)
+
+
+class Session:
+    """
+    Enable flag and stats of one app session, e.g. kept in st.session_state.
+
+    While in use (see use_session), enable(), disable(), reset(), report() and the timings
+    of the current thread apply to the session only, so sessions served by the same process
+    never see or switch each other's timings. Threads started from it (e.g. the prefetch
+    pool) are not part of the session and use the process-wide flag and stats.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = {}
+
+
+def use_session(session):
+    """Makes session the one of the current thread; None goes back to the process-wide flag and stats."""
+    _session.set(session)
+
+
+class _Stage:
+    """Handle yielded by stage(); set `rows` when the row count is only known inside the block."""
+    __slots__ = ('rows',)
+
+    def __init__(self, rows=None):
+        self.rows = rows
+
+
+_disabled_stage = _Stage()
+
+
+def _set_enabled(enabled):
+    global _enabled
+    session = _session.get()
+    if session is not None:
+        session.enabled = enabled
+    else:
+        _enabled = enabled
+
+
+def enable():
+    _set_enabled(True)
+
+
+def disable():
+    _set_enabled(False)
+
+
+def is_enabled():
+    session = _session.get()
+    return session.enabled if session is not None else _enabled
+
+
+def _current_stats():
+    session = _session.get()
+    return session.stats if session is not None else _stats
+
+
+def reset():
+    with _lock:
+        _current_stats().clear()
+
+
+def record(name, seconds, rows=None):
+    """Adds one call of `name` that took `seconds` and processed `rows` rows."""
+    with _lock:
+        entry = _current_stats().setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0})
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['max_seconds'] = max(entry['max_seconds'], seconds)
+        entry['rows'] += int(rows or 0)
+
+
+@contextmanager
+def _timed_stage(name, rows):
+    handle = _Stage(rows)
+    start = time.perf_counter()
+    try:
+        yield handle
+    finally:
+        record(name, time.perf_counter() - start, handle.rows)
+
+
+@contextmanager
+def _null_stage():
+    yield _disabled_stage
+
+
+def stage(name, rows=None):
+    """
+    Context manager timing a block as stage `name`.
+
+    Parameters:
+    name (str): Stage name, e.g. 'expand.cdi'.
+    rows (int): Rows processed by the block; can also be set later on the yielded handle.
+    """
+    if not is_enabled():
+        return _null_stage()
+    return _timed_stage(name, rows)
+
+
+def instrumented(name=None, rows=None):
+    """
+    Decorator timing every call of a function.
+
+    Parameters:
+    name (str): Stage name (default: module.function).
+    rows (callable): Function of the result returning the number of rows processed.
+    """
+    def decorator(function):
+        stage_name = name or f'{function.__module__}.{function.__qualname__}'
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            record(stage_name, time.perf_counter() - start, rows(result) if rows else None)
+            return result
+        return wrapper
+    return decorator
+
+
+def report():
+    """Returns a DataFrame with calls, total/mean/max wall time and rows per stage, slowest first."""
+    with _lock:
+        rows = [{'stage': name, **entry} for name, entry in _current_stats().items()]
+    df = pd.DataFrame(rows, columns=['stage', 'calls', 'seconds', 'max_seconds', 'rows'])
+    df['mean_seconds'] = df['seconds'] / df['calls']
+    return df.sort_values('seconds', ascending=False, ignore_index=True)
+
+
+def export_json(path=None):
+    """Returns the report as JSON, also writing it to path when given."""
+    content = json.dumps({
+        'created_at': pd.Timestamp.now().isoformat(),
+        'stages': report().to_dict(orient='records'),
+    }, indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(content)
+    return content
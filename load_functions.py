@@ -1,96 +1,93 @@
-import pandas as pd
 import json
 import os
-import io
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-
-    
-def create_credentials_file():
-    credentials_data = os.environ['CREDENTIALS']
-    
-    if not credentials_data:
-        raise ValueError("A variável de ambiente 'CREDENTIALS' está vazia ou não foi definida.")
-    try:
-        json.loads(credentials_data)
-    except json.JSONDecodeError:
-        raise ValueError("O conteúdo da variável de ambiente 'CREDENTIALS' não é um JSON válido.")
-
-    with open('credentials.json', 'w') as f:
-        f.write(credentials_data)
-
-    credentials_path = './credentials.json'
-    
-    with open(credentials_path, 'r') as f:
-        credentials = f.read()
-    
-    return credentials
-
-SCOPES = ["https://www.googleapis.com/auth/drive"]
-creds = service_account.Credentials.from_service_account_info(json.loads(create_credentials_file()), scopes=SCOPES)
-drive_service = build('drive', 'v3', credentials=creds)
-
-def get_folder_id(drive_service, folder_name):
-    query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder'"
-    results = drive_service.files().list(
-        q=query,
-        fields="files(id, name)"
-    ).execute()
-    folders = results.get('files', [])
-    if not folders:
-        print(f"Pasta '{folder_name}' não encontrada.")
-        return None
-    return folders[0]['id']
-
-def fetch_file_from_google_drive(drive_service, file_name, destination, folder_id=None):
-    query = f"name='{file_name}'"
-    if folder_id:
-        query += f" and '{folder_id}' in parents"
-    results = drive_service.files().list(
-        q=query,
-        fields="files(id, name)"
-    ).execute()
-    items = results.get('files', [])
-    
-    if not items:
-        print("Arquivo não encontrado.")
-        return False
-
-    file_id = items[0]['id']
-    request = drive_service.files().get_media(fileId=file_id)
-    fh = io.FileIO(destination, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-        print(f"Download {int(status.progress() * 100)}% concluído.")
-
-def load_and_preprocess_apys(filepath):
-    """Load and preprocess the APYs DataFrame."""
-    if not os.path.exists(filepath):
-        folder_id = get_folder_id(drive_service, "Base_simulacao")
-        fetch_file_from_google_drive(drive_service, filepath, filepath, folder_id=folder_id)
+import weakref
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from data_cache import resolve_data_file
+from instrumentation import instrumented
+from reference_data import ReferenceDataStore, file_signature
+
+# Parsed FX, CDI, FIPE and APY tables, shared by every loader in the process.
+reference_data = ReferenceDataStore()
+
+GROUP_FILE = 'santander_cotas_pre_grupo_md_cota655_202502211443.csv'
+USD_BRL_FILE = 'usd-variation.csv'
+CORRECTION_FILE = 'FIPE-GRUPO-655-FIPE.csv'
+CDI_FILE = 'cdi.csv'
+# Files read by every expansion, prefetched together on a cold start.
+REFERENCE_FILES = [USD_BRL_FILE, CORRECTION_FILE, CDI_FILE]
+APY_FILES = {
+    'aave': 'apys_aave_v2_USDC.csv',
+    'compound': 'apys_compound_USDC.csv',
+    'uniswap': 'apys_uniswap_v3-USDC-USDT.csv',
+    'balancer': 'apys_balancer_v3_USDC.csv',
+}
+
+@instrumented('load.parse_apys', rows=len)
+def _parse_apys(filepath):
     apys_df = pd.read_csv(filepath)
     apys_df.drop(labels=['APY_REWARD', 'APY_BASE', 'TVL'], axis=1, inplace=True)
     apys_df["DATE"] = pd.to_datetime(apys_df["DATE"]).dt.date
     return apys_df
 
+def load_and_preprocess_apys(filepath):
+    """Load and preprocess the APYs DataFrame."""
+    filepath = resolve_data_file(filepath)
+    apys_df = reference_data.get('apys', filepath, _parse_apys)
+    # The monthly table is a reference table of the file too; the shared frame maps to it.
+    _remember_apy_monthly_table(apys_df, reference_data.get('apy_monthly', filepath, lambda path: ApyMonthlyTable(apys_df)))
+    return apys_df
+
 def path_dict_to_df(type):
     """Reads all files in the given dictionary and concatenates them into a single DataFrame."""
-    dict_path = {
-        'aave': 'apys_aave_v2_USDC.csv',
-        'compound': 'apys_compound_USDC.csv',
-        'uniswap': 'apys_uniswap_v3-USDC-USDT.csv',
-        'balancer': 'apys_balancer_v3_USDC.csv',
-    }
-    df = load_and_preprocess_apys(dict_path[type])
+    df = load_and_preprocess_apys(APY_FILES[type])
     return df
 
 
 
+class CdiSeries:
+    """Monthly CDI on a gap-free month grid, with the cumulative product of (1 + cdi*0.85)."""
+
+    def __init__(self, df_cdi):
+        df_cdi = df_cdi.drop_duplicates('date_month').sort_values('date_month')
+        codes = df_cdi['date_month'].to_numpy(dtype='datetime64[M]').astype(np.int64)
+        self.first_month = codes[0] if len(codes) else 0
+        # Missing months take the most recent CDI before them.
+        cdi = pd.Series(df_cdi['cdi'].to_numpy(dtype=np.float64), index=codes - self.first_month)
+        cdi = cdi.reindex(np.arange(codes[-1] - self.first_month + 1 if len(codes) else 0)).ffill()
+        self.growth = 1 + cdi.to_numpy() * 0.85
+        self.cumulative = np.cumprod(self.growth)
+
+    def _positions(self, dates):
+        dates = np.asarray(pd.to_datetime(dates), dtype='datetime64[ns]')
+        return dates.astype('datetime64[M]').astype(np.int64) - self.first_month
+
+    def _cumulative(self, positions):
+        """Cumulative growth up to each position; 1.0 right before the first month."""
+        last = len(self.growth) - 1
+        cumulative = np.concatenate([[1.0], self.cumulative])
+        beyond = np.maximum(positions - last, 0)
+        return cumulative[np.clip(positions, -1, last) + 1] * self.growth[-1] ** beyond
+
+    def growth_at(self, dates):
+        """Returns (1 + cdi*0.85) for the month of each date, or the most recent month before it."""
+        positions = self._positions(dates)
+        if np.any(positions < 0) or not len(self.growth):
+            raise ValueError("No CDI data available for the given date or before.")
+        return self.growth[np.minimum(positions, len(self.growth) - 1)]
+
+    @instrumented('lookup.cdi_many', rows=len)
+    def growth_between(self, start_dates, end_dates):
+        """Returns the compounded CDI growth over the months after start_dates up to end_dates."""
+        start, end = self._positions(start_dates), self._positions(end_dates)
+        pending = end > start
+        if np.any(pending & (start < -1)) or (np.any(pending) and not len(self.growth)):
+            raise ValueError("No CDI data available for the given date or before.")
+        return np.where(pending, self._cumulative(end) / self._cumulative(start), 1.0)
+
+@instrumented('lookup.cdi')
 def aplication_cdi(amount, date_month):
     """
     Calculates the return based on the CDI for the month of the given date.
@@ -103,90 +100,217 @@ def aplication_cdi(amount, date_month):
     Returns:
     float: The calculated return based on the CDI for the month.
     """
-    df_cdi = DataFrameLoader.load_and_preprocess_cdi()
-    if not isinstance(date_month, pd.Timestamp):
-        date_month = pd.to_datetime(date_month)
-        
-    # Check for an exact match first
-    df_exact = df_cdi[df_cdi['date_month'] == date_month]
-    if not df_exact.empty:
-        cdi = float(df_exact['cdi'].iloc[0])
-    else:
-        # Find the most recent month before the given date
-        df_before = df_cdi[df_cdi['date_month'] < date_month]
-        if df_before.empty:
-            raise ValueError("No CDI data available for the given date or before.")
-        
-        df_before_sorted = df_before.sort_values('date_month')
-        cdi = float(df_before_sorted.iloc[-1]['cdi'])
-        
-    return amount * (1 + cdi*0.85)
+    cdi_series = DataFrameLoader().load_cdi_series()
+    return amount * cdi_series.growth_at([date_month])[0]
+
+
+GRUPO_DROPPED_COLUMNS = ['id_quotas_santander', 'cd_grupo', 'cd_cota', 'cd_produto', 'nm_situ_entrega_bem', 'created_at', 'is_processed', 'cd_versao_cota', 'cd_tipo_pessoa', 'pz_comercializacao', 'vl_lance_proprio']
+GRUPO_RENAME_MAP = {
+    "pc_fc_pago": "FC_paid_%",
+    "pc_fundo_reserva": "FR_%",
+    "pc_fr_pago": "FR_paid_%",
+    "pc_tx_adm": "TX_adm_%",
+    "pc_tx_pago": "TX_paid_%",
+    "pc_seguro": "Seguro_%",
+    "nr_contrato": "id",
+    "vl_bem_atual": "vl_bem",
+    "pz_restante_grupo": "remaining_period",
+    "qt_parcela_a_pagar": "parc_to_pay",
+    "pz_contratado": "contracted_period",
+    "qt_parcela_paga": "parc_paid",
+    "pz_decorrido_grupo": "T_decorrido",
+    "dt_entrega_bem": "dt_entrega",
+    "vl_lance_embutido": "embedded_bid_vl",
+    "vl_bem_corrigido": "bem_corrig_vl",
+    "vl_total_contrato": "total_contract_vl",
+    "vl_lance_proprio": "own_bid_vl",
+    "qt_pc_atraso": "qt_parc_atraso",
+    "qt_pc_lance": "qt_parc_lance",
+}
+GRUPO_DTYPES = {
+    'nr_contrato': 'int64',
+    'pc_fc_pago': 'float64',
+    'pc_fundo_reserva': 'float64',
+    'pc_fr_pago': 'float64',
+    'pc_tx_adm': 'float64',
+    'pc_tx_pago': 'float64',
+    'pc_seguro': 'float64',
+}
+# Dates kept at day precision (the time of day is dropped), as the expansion expects.
+GRUPO_DAY_COLUMNS = ['dt_canc', 'dt_contemplacao', 'dt_entrega']
+# Integer month codes (months since 1970-01) of the dates filtered by the app; missing
+# dates get NO_MONTH, the code of NaT.
+GRUPO_MONTH_COLUMNS = {'dt_venda': 'dt_venda_month', 'dt_canc': 'dt_canc_month', 'dt_contemplacao': 'dt_contemplacao_month'}
+NO_MONTH = np.iinfo(np.int64).min
+# Bump whenever the cleaned group changes, so cached Parquet files are rebuilt.
+GRUPO_CACHE_VERSION = 2
+
+def _grupo_cache_path(filepath):
+    return os.path.splitext(filepath)[0] + '.clean.parquet'
+
+def _read_grupo_cache(cache_path, signature):
+    if not os.path.exists(cache_path):
+        return None
+    metadata = pq.read_schema(cache_path).metadata or {}
+    if metadata.get(b'grupo_cache') != json.dumps([GRUPO_CACHE_VERSION, *signature]).encode():
+        return None
+    return pq.read_table(cache_path).to_pandas()
 
+def _write_grupo_cache(cache_path, signature, df):
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'grupo_cache': json.dumps([GRUPO_CACHE_VERSION, *signature]).encode()})
+    tmp_path = f'{cache_path}.tmp-{os.getpid()}'
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # A read-only data directory only loses the cache.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def month_codes(values):
+    """Months since 1970-01 of datetime64 values; NaT becomes NO_MONTH."""
+    return values.astype('datetime64[M]').astype(np.int64)
+
+def month_labels(codes):
+    """'YYYY-MM' labels of month codes, as Period('M').astype(str) writes them."""
+    return np.asarray(codes, dtype=np.int64).astype('datetime64[M]').astype(str)
+
+def grupo_usecols(filepath):
+    """Columns of a group CSV that are kept by the loader, in file order."""
+    header = pd.read_csv(filepath, nrows=0).columns
+    return [col for col in header if col not in GRUPO_DROPPED_COLUMNS]
+
+def preprocess_grupo_rows(df):
+    """
+    Renames and types the raw rows of a group CSV (already restricted to grupo_usecols).
 
-def load_and_preprocess_grupo(filepath, number_elements=None):
-    if not os.path.exists(filepath):
-        folder_id = get_folder_id(drive_service, "Base_simulacao")
-        fetch_file_from_google_drive(drive_service, filepath, filepath, folder_id=folder_id)
-    if number_elements:
-        df = pd.read_csv(filepath, nrows=number_elements, low_memory=False)
-    else:
-        df = pd.read_csv(filepath, low_memory=False)
-
-    df.drop(columns=['id_quotas_santander', 'cd_grupo', 'cd_cota', 'cd_produto', 'nm_situ_entrega_bem', 'created_at', 'is_processed', 'cd_versao_cota', 'cd_tipo_pessoa', 'pz_comercializacao', 'vl_lance_proprio'], inplace=True)
-    rename_map = {
-        "pc_fc_pago": "FC_paid_%",
-        "pc_fundo_reserva": "FR_%",
-        "pc_fr_pago": "FR_paid_%",
-        "pc_tx_adm": "TX_adm_%",
-        "pc_tx_pago": "TX_paid_%",
-        "pc_seguro": "Seguro_%",
-        "nr_contrato": "id",
-        "vl_bem_atual": "vl_bem",
-        "pz_restante_grupo": "remaining_period",
-        "qt_parcela_a_pagar": "parc_to_pay",
-        "pz_contratado": "contracted_period",
-        "qt_parcela_paga": "parc_paid",
-        "pz_decorrido_grupo": "T_decorrido",
-        "dt_entrega_bem": "dt_entrega",
-        "vl_lance_embutido": "embedded_bid_vl",
-        "vl_bem_corrigido": "bem_corrig_vl",
-        "vl_total_contrato": "total_contract_vl",
-        "vl_lance_proprio": "own_bid_vl",
-        "qt_pc_atraso": "qt_parc_atraso",
-        "qt_pc_lance": "qt_parc_lance",
-    }
-    df = df.rename(columns=rename_map)
-    
+    Returns:
+    pd.DataFrame: Rows with the loader's column names, int64 ids, datetime64[ns] dates and
+    the month codes of GRUPO_MONTH_COLUMNS.
+    """
+    df = df.rename(columns=GRUPO_RENAME_MAP)
     df['id'] = df['id'].astype(int)
-    date_columns = ['dt_canc', 'dt_contemplacao', 'data_info', 'dt_entrega']
-    for col in date_columns:
-        df[col] = pd.to_datetime(df[col]).dt.date
-    # Ensure 'data_info' is in datetime format
-    df['data_info'] = pd.to_datetime(df['data_info'])
+    df['dt_venda'] = pd.to_datetime(df['dt_venda']).astype('datetime64[ns]')
+    for col in GRUPO_DAY_COLUMNS:
+        df[col] = pd.to_datetime(df[col]).astype('datetime64[ns]').dt.normalize()
+    df['data_info'] = pd.to_datetime(df['data_info']).astype('datetime64[ns]')
+    for col, month_col in GRUPO_MONTH_COLUMNS.items():
+        df[month_col] = month_codes(df[col].to_numpy())
+    return df
+
+def latest_snapshots(df):
+    """Most recent snapshot (data_info) of each id, sorted by id; on ties the first row, like groupby().idxmax()."""
+    latest = df['data_info'] == df.groupby('id')['data_info'].transform('max')
+    return df[latest].drop_duplicates('id').sort_values('id', kind='stable')
+
+@instrumented('load.grupo', rows=len)
+def load_and_preprocess_grupo(filepath, number_elements=None, use_cache=True):
+    """
+    Loads the Santander group CSV, keeping the most recent snapshot (data_info) of each quota.
+
+    Only the used columns are read, with the pyarrow CSV engine (the C engine when
+    number_elements is given), and dates are parsed once into datetime64. The cleaned group
+    is cached as Parquet next to the CSV (<name>.clean.parquet) and reused until the CSV changes.
 
-    # Group by 'id' and get the row with the most recent 'data_info' for each group
-    df_most_recent = df.loc[df.groupby('id')['data_info'].idxmax()]
+    Parameters:
+    filepath (str): Group CSV.
+    number_elements (int): Read only the first rows of the CSV (not cached).
+    use_cache (bool): Read and write the Parquet cache.
 
+    Returns:
+    pd.DataFrame: One row per quota id, sorted by id.
+    """
+    filepath = resolve_data_file(filepath)
+    use_cache = use_cache and not number_elements
+    if use_cache:
+        signature = file_signature(filepath)
+        df_cached = _read_grupo_cache(_grupo_cache_path(filepath), signature)
+        if df_cached is not None:
+            return df_cached
+
+    usecols = grupo_usecols(filepath)
+    dtype = {col: col_dtype for col, col_dtype in GRUPO_DTYPES.items() if col in usecols}
+    if number_elements:
+        df = pd.read_csv(filepath, usecols=usecols, dtype=dtype, nrows=number_elements, low_memory=False)
+    else:
+        df = pd.read_csv(filepath, usecols=usecols, dtype=dtype, engine='pyarrow')
+    df_most_recent = latest_snapshots(preprocess_grupo_rows(df[usecols]))
+
+    if use_cache:
+        _write_grupo_cache(_grupo_cache_path(filepath), signature, df_most_recent)
     return df_most_recent
 
+class ApyMonthlyTable:
+    """Mean APY, monthly-compounded rate and mean GAS_PRICE_MED for each month of an APY series."""
+
+    def __init__(self, apys_df):
+        codes = pd.to_datetime(apys_df["DATE"]).to_numpy(dtype='datetime64[M]').astype(np.int64)
+        monthly = pd.DataFrame({
+            "APY": apys_df["APY"].to_numpy(dtype=np.float64),
+            "GAS_PRICE_MED": apys_df["GAS_PRICE_MED"].to_numpy(dtype=np.float64),
+        }).groupby(codes).mean()
+        self.months = monthly.index.to_numpy(dtype=np.int64)
+        # Months without data fall back to the first APY of the series, with no gas price.
+        # The fallback is kept as an extra last entry of each column.
+        fallback_apy = apys_df["APY"].get(0, np.nan)
+        self.apy = np.append(monthly["APY"].to_numpy(), fallback_apy)
+        self.apym = (1 + self.apy / 100) ** (1/12) - 1
+        self.gas_fee = np.append(monthly["GAS_PRICE_MED"].to_numpy(), np.nan)
+
+    def lookup(self, dates):
+        """Returns (apy, apym, gas_fee) arrays for the month of each date."""
+        codes = np.asarray(pd.to_datetime(dates), dtype='datetime64[M]').astype(np.int64)
+        positions = np.searchsorted(self.months, codes)
+        found = np.zeros(codes.shape, dtype=bool)
+        in_range = positions < len(self.months)
+        found[in_range] = self.months[positions[in_range]] == codes[in_range]
+        positions = np.where(found, positions, len(self.months))
+        return self.apy[positions], self.apym[positions], self.gas_fee[positions]
+
+# Monthly tables of the APY frames in use, by id(apys_df): (weak reference, signature, table).
+# Kept out of apys_df.attrs, which pandas copies into every frame derived from apys_df.
+_apy_monthly_tables = {}
+
+def _apy_frame_signature(apys_df):
+    dates = apys_df["DATE"]
+    return (len(dates), dates.iat[0], dates.iat[-1]) if len(dates) else (0, None, None)
+
+def _remember_apy_monthly_table(apys_df, table):
+    key = id(apys_df)
+    reference = weakref.ref(apys_df, lambda _, key=key: _apy_monthly_tables.pop(key, None))
+    _apy_monthly_tables[key] = (reference, _apy_frame_signature(apys_df), table)
+
+def get_apy_monthly_table(apys_df):
+    """
+    Returns the ApyMonthlyTable of apys_df, building it on first use.
+
+    Tables are reused for the same frame object only, and only while its length and first
+    and last DATE are unchanged; any other frame (e.g. a filtered subset) gets its own table.
+    """
+    entry = _apy_monthly_tables.get(id(apys_df))
+    if entry is not None and entry[0]() is apys_df and entry[1] == _apy_frame_signature(apys_df):
+        return entry[2]
+    table = ApyMonthlyTable(apys_df)
+    _remember_apy_monthly_table(apys_df, table)
+    return table
+
 def get_apy_by_month(target_date, df):
     """
-    Returns the average APY for the month of the given date if it exists in the dataset.
+    Returns the average APY and gas price for the month of the given date.
 
     Parameters:
-    df (pd.DataFrame): DataFrame containing 'DATE' and 'APY' columns.
+    df (pd.DataFrame): DataFrame containing 'DATE', 'APY' and 'GAS_PRICE_MED' columns.
     target_date (np.datetime64): The date to search for (used to determine the month and year).
 
     Returns:
-    float or None: The average APY value for the month if data exists, otherwise None.
+    tuple: The average APY for the month (the first APY of the dataset if the month has no data)
+    and the average gas price for the month.
     """
-    df["DATE"] = pd.to_datetime(df["DATE"])
-    target_year = pd.to_datetime(target_date).year
-    target_month = pd.to_datetime(target_date).month
-
-    monthly_data = df[(df["DATE"].dt.year == target_year) & (df["DATE"].dt.month == target_month)]
-    return monthly_data["APY"].mean() if not monthly_data.empty else df["APY"].loc[0], monthly_data["GAS_PRICE_MED"].mean()
+    apy, _, gas_fee = get_apy_monthly_table(df).lookup([target_date])
+    return apy[0], gas_fee[0]
 
+@instrumented('lookup.apy')
 def calcular_rentabilidade_mes(valor, data, apys_df=None, type='circulana'):
     """
     Calculates the return based on the average APY for the month of the given date.
@@ -201,16 +325,78 @@ def calcular_rentabilidade_mes(valor, data, apys_df=None, type='circulana'):
     float: The calculated return based on the average APY for the month.
     """
     if type == 'circulana':
-        apy, gas_fee = get_apy_by_month(data, apys_df)
-        
-        if apy is not None:
-            apym = (1 + apy / 100) ** (1/12) - 1
-            return valor * (1 + apym) - gas_fee
-        else:
-            return valor * (1 + 0.0007) - gas_fee
+        _, apym, gas_fee = get_apy_monthly_table(apys_df).lookup([data])
+        return valor * (1 + apym[0]) - gas_fee[0]
     else:
         return valor
 
+@instrumented('lookup.apy_many', rows=len)
+def calcular_rentabilidade_mes_many(valores, datas, apys_df=None, type='circulana'):
+    """
+    Vectorized calcular_rentabilidade_mes over arrays of values and dates.
+
+    Parameters:
+    valores (array-like of float): The initial investment values.
+    datas (array-like of np.datetime64): The dates to determine the month and year for APY calculation.
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+    type (str): The type of calculation (default is 'circulana').
+
+    Returns:
+    np.ndarray: The calculated returns based on the average APY for each month.
+    """
+    valores = np.asarray(valores, dtype=np.float64)
+    if type == 'circulana':
+        _, apym, gas_fee = get_apy_monthly_table(apys_df).lookup(datas)
+        return valores * (1 + apym) - gas_fee
+    else:
+        return valores
+
+class CorrectionFactorMatrix:
+    """FIPE year-to-year correction factors, indexed by (last_known_year, target_year)."""
+
+    def __init__(self, df_correction):
+        year_columns = {
+            int(col[len('valor_'):]): col for col in df_correction.columns
+            if col.startswith('valor_') and col[len('valor_'):].isdigit() and pd.api.types.is_numeric_dtype(df_correction[col])
+        }
+        # Dense grid of years, so a lookup is plain index arithmetic. Years without a
+        # column are left as not found.
+        self.first_year = min(year_columns, default=0)
+        n_years = max(year_columns, default=-1) - self.first_year + 1
+        self.factors = np.ones((max(n_years, 1), max(n_years, 1)))
+        self.found = np.zeros((max(n_years, 1), max(n_years, 1)), dtype=bool)
+
+        # The factor for a pair of years comes from the first FIPE row with both values.
+        values = {year: df_correction[col].to_numpy(dtype=np.float64) for year, col in year_columns.items()}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for last_known_year, last_known_values in values.items():
+                for target_year, target_values in values.items():
+                    rows = np.flatnonzero(~np.isnan(last_known_values) & ~np.isnan(target_values))
+                    if len(rows):
+                        i, j = last_known_year - self.first_year, target_year - self.first_year
+                        self.factors[i, j] = target_values[rows[0]] / last_known_values[rows[0]]
+                        self.found[i, j] = True
+
+    def lookup(self, last_known_years, target_years):
+        """
+        Returns the correction factors and whether FIPE data exists for each pair of years.
+
+        Parameters:
+        - last_known_years (array-like of int): The years of the known values
+        - target_years (array-like of int): The years to correct to
+
+        Returns:
+        - (factors, found): float and bool arrays, with factor 1.0 where nothing was found
+        """
+        i = np.asarray(last_known_years, dtype=np.int64) - self.first_year
+        j = np.asarray(target_years, dtype=np.int64) - self.first_year
+        n_years = len(self.found)
+        valid = (i >= 0) & (i < n_years) & (j >= 0) & (j < n_years)
+        i, j = np.where(valid, i, 0), np.where(valid, j, 0)
+        found = valid & self.found[i, j]
+        return np.where(found, self.factors[i, j], 1.0), found
+
+@instrumented('lookup.fipe')
 def find_corrected_values(given_value, last_known_year, target_year):
     """
     Find the corrected value for a target year based on a given value in the last known year,
@@ -224,32 +410,65 @@ def find_corrected_values(given_value, last_known_year, target_year):
     Returns:
     - The corrected value for the target year
     """
-    # Load the correction dataframe
-    loader = DataFrameLoader()
-    df_correction = loader.load_and_preprocess_correction('FIPE-GRUPO-655-FIPE.csv')
-    
-    # Identify the necessary columns
-    last_known_col = f"valor_{last_known_year}"
-    target_col = f"valor_{target_year}"
-    
-    if last_known_col not in df_correction.columns or target_col not in df_correction.columns:
-        return given_value  # Return original value if columns don't exist
-    
-    # Iterate through the dataframe to find a proportional match
-    for _, row in df_correction.iterrows():
-        if pd.isna(row[last_known_col]) or pd.isna(row[target_col]):
-            continue
-        
-        try:
-            # Find proportional factor from last known year to target year
-            proportion_factor = row[target_col] / row[last_known_col]
-            return given_value * proportion_factor
-        except (ZeroDivisionError, ValueError):
-            continue
-    
-    return given_value
+    factor_matrix = DataFrameLoader().load_correction_factors(CORRECTION_FILE)
+    factors, found = factor_matrix.lookup([last_known_year], [target_year])
+    if not found[0]:
+        return given_value  # Return original value if there is no FIPE data for the years
+    return given_value * factors[0]
+
+@instrumented('lookup.fipe_many', rows=len)
+def find_corrected_values_many(given_values, last_known_years, target_years):
+    """
+    Vectorized find_corrected_values over arrays of values and years.
+
+    Parameters:
+    - given_values: The known values for last_known_years
+    - last_known_years: The years of the given values
+    - target_years: The years for which we want to find the corrected values
+
+    Returns:
+    - The corrected values for the target years (np.ndarray)
+    """
+    factor_matrix = DataFrameLoader().load_correction_factors(CORRECTION_FILE)
+    factors, _ = factor_matrix.lookup(last_known_years, target_years)
+    return np.asarray(given_values, dtype=np.float64) * factors
+
+@instrumented('load.parse_usd_brl', rows=len)
+def _parse_usd_brl(filepath):
+    df_usd = pd.read_csv(filepath)
+    df_usd.drop(columns=['Último', 'Máxima', 'Mínima', 'Var%', 'Vol.'], inplace=True)
+    df_usd.columns = ['date', 'usd']
+    df_usd['date'] = pd.to_datetime(df_usd['date'], format='%d-%m-%Y', dayfirst=True)
+    df_usd['usd'] = df_usd['usd'].str.replace(',', '.').astype(float)
+    df_usd['usd'] = df_usd['usd'].apply(lambda x: x / 10)
+    return df_usd
+
+@instrumented('load.parse_correction', rows=len)
+def _parse_correction(filepath):
+    df_correction = pd.read_csv(filepath)
+    for year in range(2020, 2026):
+        df_correction[f'valor_{year}'] = (
+            df_correction[f'valor_{year}']
+            .astype(str)
+            .str.replace('.', '', regex=False)
+            .str.replace(',', '.', regex=False)
+            .astype(float)
+        )
+    df_correction['inicio_grupo'] = pd.to_datetime(df_correction['inicio_grupo'])
+    df_correction['termino_grupo'] = pd.to_datetime(df_correction['termino_grupo'])
+    return df_correction
+
+@instrumented('load.parse_cdi', rows=len)
+def _parse_cdi(filepath):
+    df_cdi = pd.read_csv(filepath)
+    df_cdi.rename(columns={'Data': 'date_month', 'Taxa de juros - CDI / Over - acumulada no mês': 'cdi'}, inplace=True)
+    df_cdi['cdi'] = df_cdi['cdi'].str.replace(',', '.').astype(float)/100
+    df_cdi['date_month'] = pd.to_datetime(df_cdi['date_month'], format='%Y-%m')
+    df_cdi = df_cdi[df_cdi['date_month'] >= pd.Timestamp('2020-01')].reset_index(drop=True)
+    return df_cdi
 
 class DataFrameLoader:
+    """Singleton access to the reference tables, cached in the process-wide reference_data store."""
     _instance = None
 
     def __new__(cls, *args, **kwargs):
@@ -257,51 +476,48 @@ class DataFrameLoader:
             cls._instance = super(DataFrameLoader, cls).__new__(cls, *args, **kwargs)
         return cls._instance
 
-    def __init__(self):
-        self.df_usd = None
-        self.df_correction = None
-
     def load_and_preprocess_usd_brl(self, filepath):
-        if not os.path.exists(filepath):
-            folder_id = get_folder_id(drive_service, "Base_simulacao")
-            fetch_file_from_google_drive(drive_service, filepath, filepath, folder_id=folder_id)
-        if self.df_usd is None:
-            self.df_usd = pd.read_csv(filepath)
-            self.df_usd.drop(columns=['Último', 'Máxima', 'Mínima', 'Var%', 'Vol.'], inplace=True)
-            self.df_usd.columns = ['date', 'usd']
-            self.df_usd['date'] = pd.to_datetime(self.df_usd['date'], format='%d-%m-%Y', dayfirst=True)
-            self.df_usd['usd'] = self.df_usd['usd'].str.replace(',', '.').astype(float)
-            self.df_usd['usd'] = self.df_usd['usd'].apply(lambda x: x / 10)
-        return self.df_usd
+        filepath = resolve_data_file(filepath)
+        return reference_data.get('usd_brl', filepath, _parse_usd_brl)
+
+    def load_usd_brl_table(self, filepath):
+        """Returns the USD/BRL series of filepath as an ExchangeRateTable."""
+        filepath = resolve_data_file(filepath)
+        return reference_data.get('usd_brl_table', filepath, lambda path: ExchangeRateTable(self.load_and_preprocess_usd_brl(path)))
 
     def load_and_preprocess_correction(self, filepath):
-        if not os.path.exists(filepath):
-            folder_id = get_folder_id(drive_service, "Base_simulacao")
-            fetch_file_from_google_drive(drive_service, filepath, filepath, folder_id=folder_id)
-        if self.df_correction is None:
-            self.df_correction = pd.read_csv(filepath)
-            for year in range(2020, 2026):
-                self.df_correction[f'valor_{year}'] = (
-                    self.df_correction[f'valor_{year}']
-                    .astype(str)
-                    .str.replace('.', '', regex=False)
-                    .str.replace(',', '.', regex=False)
-                    .astype(float)
-                )
-            self.df_correction['inicio_grupo'] = pd.to_datetime(self.df_correction['inicio_grupo'])
-            self.df_correction['termino_grupo'] = pd.to_datetime(self.df_correction['termino_grupo'])
-        return self.df_correction
-    def load_and_preprocess_cdi(filepath = 'cdi.csv'):
+        filepath = resolve_data_file(filepath)
+        return reference_data.get('correction', filepath, _parse_correction)
+
+    def load_correction_factors(self, filepath):
+        """Returns the FIPE table of filepath as a CorrectionFactorMatrix."""
+        filepath = resolve_data_file(filepath)
+        return reference_data.get('correction_factors', filepath, lambda path: CorrectionFactorMatrix(self.load_and_preprocess_correction(path)))
+
+    @staticmethod
+    def load_and_preprocess_cdi(filepath = CDI_FILE):
         """Load and preprocess the CDI DataFrame."""
-        if not os.path.exists(filepath):
-            folder_id = get_folder_id(drive_service, "Base_simulacao")
-            fetch_file_from_google_drive(drive_service, filepath, filepath, folder_id=folder_id)
-        df_cdi = pd.read_csv(filepath)
-        df_cdi.rename(columns={'Data': 'date_month', 'Taxa de juros - CDI / Over - acumulada no mês': 'cdi'}, inplace=True)
-        df_cdi['cdi'] = df_cdi['cdi'].str.replace(',', '.').astype(float)/100
-        df_cdi['date_month'] = pd.to_datetime(df_cdi['date_month'], format='%Y-%m')
-        df_cdi = df_cdi[df_cdi['date_month'] >= pd.Timestamp('2020-01')].reset_index(drop=True)
-        return df_cdi
+        filepath = resolve_data_file(filepath)
+        return reference_data.get('cdi', filepath, _parse_cdi)
+
+    def load_cdi_series(self, filepath=CDI_FILE):
+        """Returns the CDI of filepath as a CdiSeries."""
+        filepath = resolve_data_file(filepath)
+        return reference_data.get('cdi_series', filepath, lambda path: CdiSeries(DataFrameLoader.load_and_preprocess_cdi(path)))
+
+def warm_reference_tables(apys_df=None):
+    """
+    Loads every reference table read by the expansion, so that forked workers inherit them.
+
+    Parameters:
+    apys_df (pd.DataFrame): DataFrame containing APY data, whose monthly table is built too.
+    """
+    loader = DataFrameLoader()
+    loader.load_usd_brl_table(USD_BRL_FILE)
+    loader.load_correction_factors(CORRECTION_FILE)
+    loader.load_cdi_series(CDI_FILE)
+    if apys_df is not None:
+        get_apy_monthly_table(apys_df)
 
 def correct_real(initial_date, initial_amount=1.0, final_date=None, correction_type='daily'):
     """
@@ -357,6 +573,36 @@ def correct_real(initial_date, initial_amount=1.0, final_date=None, correction_t
 
     return round(current_amount, 4)
 
+class ExchangeRateTable:
+    """USD/BRL series compiled into sorted datetime64/float64 arrays for binary-search lookups."""
+
+    def __init__(self, df_usd):
+        df_sorted = df_usd.sort_values('date', kind='stable')
+        self.dates = df_sorted['date'].to_numpy(dtype='datetime64[ns]')
+        self.rates = df_sorted['usd'].to_numpy(dtype=np.float64)
+
+    def rates_at(self, dates):
+        """Returns the latest rate before or on each of the given dates."""
+        dates = np.asarray(pd.to_datetime(dates, format='%d-%m-%Y'), dtype='datetime64[ns]')
+        positions = np.searchsorted(self.dates, dates, side='right') - 1
+        if np.any(positions < 0):
+            raise ValueError("No exchange rate data available for the given date or earlier.")
+        return self.rates[positions]
+
+def get_exchange_rate(date):
+    """
+    Returns the USD/BRL exchange rate for a given date.
+
+    Parameters:
+    - date (str or datetime): The date for the exchange rate.
+
+    Returns:
+    - Latest available rate before or on the given date (float).
+    """
+    table = DataFrameLoader().load_usd_brl_table(USD_BRL_FILE)
+    return table.rates_at([date])[0]
+
+@instrumented('lookup.fx')
 def convert_currency(date, amount, to_currency='usd'):
     """
     Converts an amount between BRL and USD based on the exchange rate of a given date.
@@ -369,21 +615,35 @@ def convert_currency(date, amount, to_currency='usd'):
     Returns:
     - Converted amount (float).
     """
-    loader = DataFrameLoader()
-    df_usd = loader.load_and_preprocess_usd_brl('usd-variation.csv')
+    exchange_rate = get_exchange_rate(date)
 
-    date = pd.to_datetime(date, format='%d-%m-%Y')
+    if to_currency == 'usd':
+        return round(amount / exchange_rate, 4)  # BRL → USD
+    elif to_currency == 'brl':
+        return round(amount * exchange_rate, 4)  # USD → BRL
+    else:
+        raise ValueError("Invalid currency conversion type. Use 'usd' or 'brl'.")
 
-    # Find the closest available date with exchange data
-    df_filtered = df_usd[df_usd['date'] <= date]
-    if df_filtered.empty:
-        raise ValueError("No exchange rate data available for the given date or earlier.")
+@instrumented('lookup.fx_many', rows=len)
+def convert_currency_many(dates, amounts, to_currency='usd'):
+    """
+    Converts arrays of amounts between BRL and USD based on the exchange rate of each date.
 
-    exchange_rate = df_filtered.iloc[-1]['usd']  # Latest available rate before or on the given date
+    Parameters:
+    - dates (array-like of str or datetime): The dates for the conversions.
+    - amounts (array-like of float): The amounts to be converted.
+    - to_currency (str): 'usd' to convert BRL → USD, 'brl' to convert USD → BRL.
+
+    Returns:
+    - Converted amounts (np.ndarray).
+    """
+    table = DataFrameLoader().load_usd_brl_table(USD_BRL_FILE)
+    exchange_rates = table.rates_at(dates)
+    amounts = np.asarray(amounts, dtype=np.float64)
 
     if to_currency == 'usd':
-        return round(amount / exchange_rate, 4)  # BRL → USD
+        return np.round(amounts / exchange_rates, 4)  # BRL → USD
     elif to_currency == 'brl':
-        return round(amount * exchange_rate, 4)  # USD → BRL
+        return np.round(amounts * exchange_rates, 4)  # USD → BRL
     else:
-        raise ValueError("Invalid currency conversion type. Use 'usd' or 'brl'.")
\ No newline at end of file
+        raise ValueError("Invalid currency conversion type. Use 'usd' or 'brl'.")
@@ -0,0 +1,271 @@
+import itertools
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from instrumentation import instrumented, stage
+from load_functions import NO_MONTH, DataFrameLoader, USD_BRL_FILE, get_apy_monthly_table
+
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+MONTE_CARLO_METRICS = ('profits_colateral', 'profits_bem')
+
+
+def _month_starts(codes):
+    return np.asarray(codes, dtype=np.int64).astype('datetime64[M]').astype('datetime64[ns]')
+
+
+def historical_months(apys_df):
+    """
+    Historical months that synthetic paths are bootstrapped from.
+
+    Each month gives a (apym, gas_fee, USD/BRL log-return) triple, drawn together so that
+    the relation between yields, gas and the exchange rate of a month is kept.
+
+    Parameters:
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+
+    Returns:
+    pd.DataFrame: Columns month (month code), apym, gas_fee and fx_log_return.
+    """
+    table = get_apy_monthly_table(apys_df)
+    fx_table = DataFrameLoader().load_usd_brl_table(USD_BRL_FILE)
+    months = table.months
+    apym = table.apym[:len(months)]
+    gas_fee = table.gas_fee[:len(months)]
+    # The return of a month needs the rates at its start and at the previous month's start.
+    with_fx = _month_starts(months - 1) >= fx_table.dates[0] if len(fx_table.dates) else np.zeros(len(months), dtype=bool)
+    usable = with_fx & np.isfinite(apym) & np.isfinite(gas_fee)
+    months = months[usable]
+    fx_log_return = np.log(fx_table.rates_at(_month_starts(months)) / fx_table.rates_at(_month_starts(months - 1)))
+    return pd.DataFrame({'month': months, 'apym': apym[usable], 'gas_fee': gas_fee[usable], 'fx_log_return': fx_log_return})
+
+
+def quota_contemplation(df_expanded_circulana):
+    """
+    Per-quota inputs of the collateral yield, from a circulana expansion (sorted by id).
+
+    Returns:
+    pd.DataFrame: id, first and last contemplated month codes (NO_MONTH when never contemplated),
+    bem_contemplacao (R$) and colateral_initial, the default collateral of expandir_cotas.
+    """
+    ids = df_expanded_circulana['id'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.zeros(0, dtype=np.int64)
+    rows = np.flatnonzero(df_expanded_circulana['contemplated'].to_numpy(dtype=bool))
+    # Position of each quota's first and last contemplated rows; rows outside the quota when never contemplated.
+    first = rows[np.minimum(np.searchsorted(rows, starts), max(len(rows) - 1, 0))] if len(rows) else starts
+    last = rows[np.maximum(np.searchsorted(rows, np.r_[starts[1:], len(ids)]) - 1, 0)] if len(rows) else starts
+    is_contemplated = (ids[first] == ids[starts]) & (ids[last] == ids[starts]) if len(rows) else np.zeros(len(starts), dtype=bool)
+    first = np.where(is_contemplated, first, starts)
+    last = np.where(is_contemplated, last, starts)
+    codes = df_expanded_circulana['month'].to_numpy().astype('datetime64[M]').astype(np.int64)
+    return pd.DataFrame({
+        'id': ids[starts],
+        'first_month': np.where(is_contemplated, codes[first], NO_MONTH),
+        'last_month': np.where(is_contemplated, codes[last], NO_MONTH),
+        'bem_contemplacao': np.where(is_contemplated, df_expanded_circulana['vl_bem'].to_numpy()[first], 0.0),
+        'colateral_initial': np.where(is_contemplated, df_expanded_circulana['colateral_initial'].to_numpy()[last], 0.0),
+    })
+
+
+def _window_sums(values, first, last):
+    """Sums of values[:, first:last + 1] per window; NaN only for windows containing a NaN month."""
+    missing = np.isnan(values)
+    zeros = np.zeros((len(values), 1))
+    totals = np.concatenate([zeros, np.cumsum(np.where(missing, 0.0, values), axis=1)], axis=1)
+    n_missing = np.concatenate([zeros, np.cumsum(missing, axis=1)], axis=1)
+    sums = totals[:, last + 1] - totals[:, first]
+    return np.where(n_missing[:, last + 1] > n_missing[:, first], np.nan, sums)
+
+
+def evaluate_paths(quotas, first_month, apym, gas_fee, fx, colateral=None):
+    """
+    Final profits_colateral and profits_bem (R$) of every quota along every path.
+
+    Over a quota's contemplated months the yield of expandir_cotas adds up to
+    valor * sum(apym) - sum(gas_fee) dollars, so each quota only needs prefix sums of the
+    path at its first and last contemplated months.
+
+    Parameters:
+    quotas (pd.DataFrame): From quota_contemplation.
+    first_month (int): Month code of the first column of the paths.
+    apym, gas_fee, fx (np.ndarray): (paths, months) monthly rate, gas fee and USD/BRL rate.
+    colateral (float): Collateral fraction the quotas were expanded with (see expandir_cotas).
+
+    Returns:
+    tuple: (profits_colateral, profits_bem), (paths, quotas) arrays; 0 for quotas never contemplated.
+    """
+    contemplated = quotas['first_month'].to_numpy() != NO_MONTH
+    first = quotas['first_month'].to_numpy()[contemplated] - first_month
+    last = quotas['last_month'].to_numpy()[contemplated] - first_month
+    apym_total = _window_sums(apym, first, last)
+    gas_total = _window_sums(gas_fee, first, last)
+
+    bem_contemplacao_dolar = np.round(quotas['bem_contemplacao'].to_numpy()[contemplated] / fx[:, first], 4)
+    if colateral is None:
+        valor_colateral = quotas['colateral_initial'].to_numpy()[contemplated]
+    else:
+        valor_colateral = colateral * bem_contemplacao_dolar
+    fx_last = fx[:, last]
+
+    profits_colateral = np.zeros((len(apym), len(quotas)))
+    profits_bem = np.zeros((len(apym), len(quotas)))
+    profits_colateral[:, contemplated] = np.round((valor_colateral * apym_total - gas_total) * fx_last, 4)
+    profits_bem[:, contemplated] = np.round((bem_contemplacao_dolar * apym_total - gas_total) * fx_last, 4)
+    return profits_colateral, profits_bem
+
+
+# Inputs shared by every chunk of a simulation, set once per process by _init_simulation.
+_worker_state = {}
+
+
+def _init_simulation(history, quotas, first_month, n_months, fx_start, colateral):
+    _worker_state.update(history=history, quotas=quotas, first_month=first_month, n_months=n_months, fx_start=fx_start, colateral=colateral)
+
+
+def _histogram(values, low, high, n_bins):
+    """Counts of values (paths, quotas) in n_bins equal bins per quota between low and high; (quotas, bins)."""
+    width = np.where(high > low, (high - low) / n_bins, 1.0)
+    bins = np.clip(((values - low) / width).astype(np.int64), 0, n_bins - 1)
+    flat = bins + np.arange(values.shape[1]) * n_bins
+    return np.bincount(flat.ravel(), minlength=values.shape[1] * n_bins).reshape(values.shape[1], n_bins)
+
+
+def _simulate_chunk(seed, n_paths, bounds=None, n_bins=None):
+    """
+    Draws n_paths paths from the seed, evaluates them and reduces them per quota.
+
+    Returns, per metric, (sum, min, max) over the paths, or with bounds (per metric
+    (low, high) arrays) the histogram of the paths; never the (paths, quotas) arrays.
+    """
+    state = _worker_state
+    history = state['history']
+    rng = np.random.default_rng(seed)
+    draws = rng.integers(0, len(history['apym']), size=(n_paths, state['n_months']))
+    fx_log_return = history['fx_log_return'][draws]
+    fx_log_return[:, 0] = 0.0
+    fx = state['fx_start'] * np.exp(np.cumsum(fx_log_return, axis=1))
+    metrics = evaluate_paths(state['quotas'], state['first_month'], history['apym'][draws], history['gas_fee'][draws], fx, state['colateral'])
+    if bounds is None:
+        return tuple((values.sum(axis=0), values.min(axis=0), values.max(axis=0)) for values in metrics)
+    return tuple(_histogram(values, low, high, n_bins) for values, (low, high) in zip(metrics, bounds))
+
+
+def _order_statistic(counts, cumulative, low, high, rank):
+    """Estimates of the rank-th smallest value per quota, spread evenly within its bin; the extremes are exact."""
+    if rank == 0:
+        return low
+    if rank == cumulative[0, -1] - 1:
+        return high
+    rows = np.arange(len(counts))
+    bins = np.minimum((cumulative <= rank).sum(axis=1), counts.shape[1] - 1)
+    before = np.where(bins > 0, cumulative[rows, bins - 1], 0)
+    return low + (bins + (rank - before + 0.5) / np.maximum(counts[rows, bins], 1)) * (high - low) / counts.shape[1]
+
+
+def _histogram_percentiles(counts, low, high, percentiles):
+    """
+    Percentiles estimated from per-quota histograms (quotas, bins) between low and high.
+
+    As np.percentile, a percentile interpolates linearly between two order statistics; each
+    is estimated within its bin, so the result is within one bin width of the exact one.
+    """
+    cumulative = counts.cumsum(axis=1)
+    columns = []
+    for q in percentiles:
+        rank = q / 100 * (cumulative[0, -1] - 1)
+        below = _order_statistic(counts, cumulative, low, high, math.floor(rank))
+        above = _order_statistic(counts, cumulative, low, high, math.ceil(rank))
+        columns.append(np.clip(below + (rank - math.floor(rank)) * (above - below), low, high))
+    return columns
+
+
+def _reduce_chunks(map_chunks, n_bins):
+    """
+    Runs both passes of simulate_profits, adding up the chunks in order.
+
+    Parameters:
+    map_chunks (callable): map_chunks(*iterables) maps _simulate_chunk over the chunks, in order,
+    with the extra arguments taken from the iterables.
+    n_bins (int): Histogram bins.
+
+    Returns:
+    list: Per metric, a (sum, min, max, histogram) tuple of per-quota arrays.
+    """
+    stats = None
+    for chunk in map_chunks():
+        stats = list(chunk) if stats is None else [
+            (total + chunk_total, np.minimum(low, chunk_low), np.maximum(high, chunk_high))
+            for (total, low, high), (chunk_total, chunk_low, chunk_high) in zip(stats, chunk)
+        ]
+    bounds = tuple((low, high) for _, low, high in stats)
+    counts = None
+    for chunk in map_chunks(itertools.repeat(bounds), itertools.repeat(n_bins)):
+        counts = list(chunk) if counts is None else [total + chunk_counts for total, chunk_counts in zip(counts, chunk)]
+    return [(total, low, high, metric_counts) for (total, low, high), metric_counts in zip(stats, counts)]
+
+
+@instrumented('montecarlo.simulate_profits')
+def simulate_profits(df_expanded_circulana, apys_df, n_paths=1000, colateral=None, seed=0, chunk_size=250, max_workers=None, percentiles=DEFAULT_PERCENTILES, n_bins=256):
+    """
+    Distribution of each quota's collateral and good yields over bootstrapped APY and USD/BRL paths.
+
+    Every path draws, for each simulated month, one historical month (with replacement) and
+    takes its apym, gas fee and USD/BRL log-return. The exchange rate starts at the historical
+    rate of the first simulated month. Paths are evaluated in chunks of chunk_size; chunk i
+    always uses the i-th child of the seed, so results do not depend on max_workers.
+    Yields are simple, as in expandir_cotas with compounded=False.
+
+    Each chunk is reduced per quota as soon as it is evaluated, so memory grows with
+    chunk_size * quotas and quotas * n_bins, never with n_paths * quotas. The price is that
+    every path is drawn and evaluated twice: a first pass keeps sums, minimums and maximums;
+    a second pass regenerates the same chunks and counts them in n_bins equal bins between
+    each quota's minimum and maximum. Means are exact; percentiles are within one bin,
+    (max - min) / n_bins, of the exact sample percentiles.
+
+    Parameters:
+    df_expanded_circulana (pd.DataFrame): Circulana expansion, sorted by id.
+    apys_df (pd.DataFrame): DataFrame containing APY data.
+    n_paths (int): Number of paths.
+    colateral (float): Collateral fraction the frame was expanded with (see expandir_cotas).
+    seed (int): Random seed.
+    chunk_size (int): Paths evaluated at once; bounds the memory of the (paths, quotas) arrays of a chunk.
+    max_workers (int): Worker processes; None or 1 runs in this process.
+    percentiles (tuple): Percentiles to report.
+    n_bins (int): Histogram bins per quota and metric for the percentiles.
+
+    Returns:
+    pd.DataFrame: One row per quota id and metric (profits_colateral, profits_bem, in R$)
+    with the mean and a 'p<q>' column per percentile.
+    """
+    if n_paths < 1 or chunk_size < 1:
+        raise ValueError(f"n_paths and chunk_size must be at least 1, got {n_paths} and {chunk_size}.")
+    quotas = quota_contemplation(df_expanded_circulana)
+    contemplated = quotas['first_month'] != NO_MONTH
+    history = {name: values.to_numpy() for name, values in historical_months(apys_df).items()}
+    if not len(history['month']):
+        raise ValueError("No historical month has APY, gas and exchange rate data to bootstrap from.")
+    first_month = int(quotas.loc[contemplated, 'first_month'].min()) if contemplated.any() else 0
+    n_months = int(quotas.loc[contemplated, 'last_month'].max()) - first_month + 1 if contemplated.any() else 1
+    fx_start = DataFrameLoader().load_usd_brl_table(USD_BRL_FILE).rates_at(_month_starts([first_month]))[0]
+
+    sizes = [min(chunk_size, n_paths - start) for start in range(0, n_paths, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    initargs = (history, quotas, first_month, n_months, fx_start, colateral)
+    with stage('montecarlo.paths', rows=2 * n_paths * len(quotas)):
+        if not max_workers or max_workers == 1:
+            _init_simulation(*initargs)
+            results = _reduce_chunks(lambda *args: map(_simulate_chunk, seeds, sizes, *args), n_bins)
+        else:
+            mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+            chunksize = max(1, math.ceil(len(sizes) / (max_workers * 4)))
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_simulation, initargs=initargs) as executor:
+                results = _reduce_chunks(lambda *args: executor.map(_simulate_chunk, seeds, sizes, *args, chunksize=chunksize), n_bins)
+
+    frames = []
+    for metric, (total, low, high, counts) in zip(MONTE_CARLO_METRICS, results):
+        frame = pd.DataFrame({'id': quotas['id'].to_numpy(), 'metric': metric, 'mean': total / n_paths})
+        for q, column in zip(percentiles, _histogram_percentiles(counts, low, high, percentiles)):
+            frame[f'p{q:g}'] = column
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True).sort_values(['id', 'metric'], kind='stable', ignore_index=True)
@@ -0,0 +1,167 @@
+"""
+Precomputes the expanded artifacts of the app's scenarios, headless.
+
+Usage:
+    python precompute.py
+    python precompute.py --protocols aave compound --collaterals 0.2 0.4 --compounded both
+    python precompute.py --tx-adm-circulana 0.05 0.08 --max-workers 4
+
+By default every protocol and collateral of the app's sidebar is expanded, so the app always
+finds a ready artifact. Scenarios are expanded in parallel into the scenario cache (see
+scenario_cache.ScenarioCache), which keys them by version, parameters and input checksums.
+The scenarios are pinned, so they are never evicted, and listed with their keys in
+<cache root>/manifest.json. Later runs add to the manifest; scenarios whose inputs or
+versions changed since are unpinned and dropped from it.
+"""
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from artifacts import SCHEMA_VERSION
+from data_cache import data_file_checksum, prefetch_data_files
+from load_functions import APY_FILES
+from scenario_cache import SCENARIO_VERSION, ScenarioCache, collateral_options, default_cache, scenario_inputs, scenario_params
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def parameter_sets(protocols=None, collaterals=None, compounded=(False,), tx_adm_circulana=(None,)):
+    """
+    Scenario parameters of every combination of the given values, without duplicates.
+
+    Parameters:
+    protocols (list): Protocols (default: every protocol of APY_FILES).
+    collaterals (list): Collateral fractions (default: the values of the app's slider).
+    compounded (list): Compounded modes.
+    tx_adm_circulana (list): Circulana administration fees; None is the first quota's fee.
+
+    Returns:
+    list: Dicts as returned by scenario_params.
+    """
+    protocols = protocols or list(APY_FILES)
+    collaterals = collateral_options() if collaterals is None else collaterals
+    scenarios = {}
+    for combination in itertools.product(protocols, collaterals, compounded, tx_adm_circulana):
+        params = scenario_params(*combination)
+        scenarios[json.dumps(params, sort_keys=True)] = params
+    return list(scenarios.values())
+
+
+def _precompute_scenario(root, params):
+    # Workers never evict; the parent pins the scenarios and evicts once all are written.
+    cache = ScenarioCache(root, max_bytes=math.inf)
+    start = time.perf_counter()
+    cached = cache.get(cache.key(params, scenario_inputs(params)), params) is not None
+    path = cache.get_or_compute(params)
+    return {'params': params, 'key': os.path.basename(path), 'computed': not cached, 'seconds': round(time.perf_counter() - start, 3)}
+
+
+def precompute(scenarios, cache=None, max_workers=None, log=print):
+    """
+    Expands every scenario missing from the cache in a process pool and writes the manifest.
+
+    Parameters:
+    scenarios (list): Dicts as returned by scenario_params.
+    cache (ScenarioCache): Cache to fill (default: default_cache()).
+    max_workers (int): Worker processes (default: CPU count, at most one per scenario).
+    log (callable): Receives a progress line per scenario.
+
+    Returns:
+    dict: The manifest.
+    """
+    cache = cache or default_cache()
+    input_files = sorted({name for params in scenarios for name in scenario_inputs(params)})
+    # Fetched once here, so workers never download the same file concurrently.
+    prefetch_data_files(input_files)
+    max_workers = max_workers or min(len(scenarios), os.cpu_count() or 1)
+
+    results = []
+    def collect(result):
+        results.append(result)
+        status = 'computed' if result['computed'] else 'cached'
+        log(f"[{len(results)}/{len(scenarios)}] {status:8} {result['seconds']:8.2f}s {json.dumps(result['params'], sort_keys=True)}")
+
+    if max_workers <= 1:
+        for params in scenarios:
+            collect(_precompute_scenario(cache.root, params))
+    else:
+        mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            for future in as_completed([executor.submit(_precompute_scenario, cache.root, params) for params in scenarios]):
+                collect(future.result())
+
+    # Workers update the index concurrently and may overwrite each other's entries; touching
+    # every scenario from this process restores them before pinning.
+    order = {json.dumps(params, sort_keys=True): position for position, params in enumerate(scenarios)}
+    results.sort(key=lambda result: order[json.dumps(result['params'], sort_keys=True)])
+    for result in results:
+        cache.get(result['key'], result['params'])
+    entries = {result['key']: {**result['params'], 'key': result['key'], 'computed': result['computed'], 'seconds': result['seconds']} for result in results}
+    # Scenarios of previous runs stay pinned while their key is current and their artifact exists.
+    for entry in _read_manifest(cache).get('scenarios', []):
+        params = _entry_params(entry)
+        if entry['key'] not in entries and cache.key(params, scenario_inputs(params)) == entry['key'] and cache.get(entry['key'], params):
+            entries[entry['key']] = entry
+    cache.pin(entries)
+    cache.evict()
+
+    manifest = {
+        'created_at': pd.Timestamp.now().isoformat(),
+        'scenario_version': SCENARIO_VERSION,
+        'artifact_schema_version': SCHEMA_VERSION,
+        'inputs': {name: data_file_checksum(name) for name in sorted({name for entry in entries.values() for name in scenario_inputs(_entry_params(entry))})},
+        'scenarios': list(entries.values()),
+    }
+    manifest_path = os.path.join(cache.root, MANIFEST_FILE)
+    tmp_path = f'{manifest_path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def _entry_params(entry):
+    return scenario_params(entry['protocol'], entry['collateral'], entry['compounded'], entry['tx_adm_circulana'])
+
+
+def _read_manifest(cache):
+    manifest_path = os.path.join(cache.root, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _fee(value):
+    return None if value.lower() == 'none' else float(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--protocols', nargs='+', choices=list(APY_FILES), help='Protocols (default: all).')
+    parser.add_argument('--collaterals', type=float, nargs='+', help="Collateral fractions (default: every value of the app's slider).")
+    parser.add_argument('--compounded', choices=['no', 'yes', 'both'], default='no', help='Compounded modes to expand.')
+    parser.add_argument('--tx-adm-circulana', type=_fee, nargs='+', default=[None], help="Circulana fees; 'none' uses the first quota's fee.")
+    parser.add_argument('--max-workers', type=int, help='Worker processes (default: CPU count).')
+    parser.add_argument('--cache-dir', help='Scenario cache directory (default: the app\'s cache in the data directory).')
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    compounded = {'no': [False], 'yes': [True], 'both': [False, True]}[args.compounded]
+    scenarios = parameter_sets(args.protocols, args.collaterals, compounded, args.tx_adm_circulana)
+    cache = ScenarioCache(args.cache_dir) if args.cache_dir else default_cache()
+    start = time.perf_counter()
+    manifest = precompute(scenarios, cache=cache, max_workers=args.max_workers)
+    print(f"{len(scenarios)} scenarios ready in {time.perf_counter() - start:.1f}s; {len(manifest['scenarios'])} pinned scenarios in {os.path.join(cache.root, MANIFEST_FILE)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+
+def file_signature(filepath):
+    """Returns (mtime_ns, size) of a file, used to detect changes without reading it."""
+    stat = os.stat(filepath)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def memory_footprint(value):
+    """Approximate resident size in bytes of a parsed table."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(memory_footprint(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(memory_footprint(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return memory_footprint(vars(value))
+    return 0
+
+
+class ReferenceDataStore:
+    """
+    Process-wide cache of parsed reference tables (FX, CDI, FIPE, APY).
+
+    Each table is parsed once per process. On every access the file's mtime and size are
+    checked; when they change the content hash is compared and the table is only parsed
+    again if the content really changed. Load time, hit/miss counts and memory footprint
+    are kept per table.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def get(self, name, filepath, parser):
+        """
+        Returns the table `name` parsed from filepath, loading it on first use or when the file changed.
+
+        Parameters:
+        name (str): Name of the table, e.g. 'usd_brl'.
+        filepath (str): Path of the source file.
+        parser (callable): Function receiving filepath and returning the parsed table.
+
+        Returns:
+        The parsed table, shared by every caller.
+        """
+        key = (name, filepath)
+        signature = file_signature(filepath)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['signature'] != signature:
+                digest = file_digest(filepath)
+                if digest == entry['digest']:
+                    entry['signature'] = signature
+                else:
+                    entry['stale'] = True
+            if entry is not None and not entry.get('stale'):
+                entry['hits'] += 1
+                return entry['value']
+
+            start = time.perf_counter()
+            value = parser(filepath)
+            load_seconds = time.perf_counter() - start
+            previous = entry or {'loads': 0, 'hits': 0, 'misses': 0}
+            self._entries[key] = {
+                'value': value,
+                'signature': signature,
+                'digest': file_digest(filepath),
+                'loads': previous['loads'] + 1,
+                'hits': previous['hits'],
+                'misses': previous['misses'] + 1,
+                'load_seconds': load_seconds,
+                'nbytes': memory_footprint(value),
+            }
+            return value
+
+    def invalidate(self, name=None):
+        """Drops every cached table, or only the tables called `name`."""
+        with self._lock:
+            for key in [key for key in self._entries if name is None or key[0] == name]:
+                del self._entries[key]
+
+    def stats(self):
+        """Returns a DataFrame with loads, hits, misses, last load time and memory footprint per table."""
+        with self._lock:
+            rows = [
+                {
+                    'table': name,
+                    'file': filepath,
+                    'loads': entry['loads'],
+                    'hits': entry['hits'],
+                    'misses': entry['misses'],
+                    'load_seconds': entry['load_seconds'],
+                    'nbytes': entry['nbytes'],
+                }
+                for (name, filepath), entry in self._entries.items()
+            ]
+        return pd.DataFrame(rows, columns=['table', 'file', 'loads', 'hits', 'misses', 'load_seconds', 'nbytes'])
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import pandas as pd
+from artifacts import SCHEMA_VERSION, artifact_exists, write_expanded_artifact
+from cotas_processor import write_expanded_dataset
+from data_cache import data_file_checksum, data_path, prefetch_data_files, resolve_data_file
+from instrumentation import stage
+from load_functions import APY_FILES, GROUP_FILE, REFERENCE_FILES, load_and_preprocess_grupo, path_dict_to_df
+
+# Bump whenever the expansion gives different results for the same inputs and parameters.
+SCENARIO_VERSION = 3
+SCENARIO_DIR = 'scenarios'
+INDEX_FILE = 'index.json'
+MAX_CACHE_BYTES = int(os.environ.get('SIMULACAO_SCENARIO_CACHE_BYTES', 4 * 1024 ** 3))
+
+# The aave scenario with 40% collateral is precomputed and hosted on Drive as pickles.
+PRECOMPUTED_SCENARIO = {'protocol': 'aave', 'collateral': 0.4, 'compounded': False, 'tx_adm_circulana': None}
+PRECOMPUTED_PICKLES = ['df_expanded_consorcio.pkl', 'df_expanded_circulana.pkl']
+# Collateral slider of the app: 0 to 1 in steps of COLLATERAL_STEP.
+COLLATERAL_STEP = 0.05
+
+
+def scenario_params(protocol, collateral=0.4, compounded=False, tx_adm_circulana=None):
+    """Normalizes the parameters of a scenario, so that equal scenarios get equal keys."""
+    if protocol not in APY_FILES:
+        raise ValueError(f"Invalid protocol '{protocol}'. Use one of {list(APY_FILES)}.")
+    return {
+        'protocol': protocol,
+        'collateral': round(float(collateral), 6),
+        'compounded': bool(compounded),
+        'tx_adm_circulana': None if tx_adm_circulana is None else round(float(tx_adm_circulana), 10),
+    }
+
+
+def collateral_options():
+    """Collateral values offered by the app's slider."""
+    return [round(i * COLLATERAL_STEP, 6) for i in range(int(round(1 / COLLATERAL_STEP)) + 1)]
+
+
+def scenario_inputs(params):
+    """Input files whose content determines the result of a scenario."""
+    if params == PRECOMPUTED_SCENARIO:
+        return [GROUP_FILE] + PRECOMPUTED_PICKLES
+    return [GROUP_FILE, APY_FILES[params['protocol']]] + REFERENCE_FILES
+
+
+def expand_scenario(path, params):
+    """Computes a scenario and writes it as an expanded artifact at path."""
+    if params == PRECOMPUTED_SCENARIO:
+        frames = [pd.read_pickle(resolve_data_file(file_name)) for file_name in PRECOMPUTED_PICKLES]
+        write_expanded_artifact(path, *frames)
+        return
+    df_grupo = load_and_preprocess_grupo(GROUP_FILE)
+    apys_df = path_dict_to_df(params['protocol'])
+    write_expanded_dataset(df_grupo, path, apys_df=apys_df, tx_adm_circulana=params['tx_adm_circulana'], colateral=params['collateral'], compounded=params['compounded'])
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class ScenarioCache:
+    """
+    On-disk cache of expanded scenarios, addressed by a hash of the scenario parameters and
+    of the content of its input files.
+
+    Each scenario is an expanded artifact in root/<key>. An index keeps its parameters, size
+    and last use; when the cache grows beyond max_bytes the least recently used scenarios
+    are deleted, except pinned ones (see precompute.py). Changing an input file changes the
+    key, so stale results are never read; entries written by other scenario or artifact
+    versions can never be read again either and are deleted first.
+    """
+
+    def __init__(self, root=None, max_bytes=MAX_CACHE_BYTES):
+        self.root = root or data_path(SCENARIO_DIR)
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, params, input_files):
+        payload = {
+            'scenario_version': SCENARIO_VERSION,
+            'artifact_schema_version': SCHEMA_VERSION,
+            'params': params,
+            'inputs': {name: data_file_checksum(name) for name in sorted(input_files)},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def _read_index(self):
+        index_path = os.path.join(self.root, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        index_path = os.path.join(self.root, INDEX_FILE)
+        tmp_path = f'{index_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, index_path)
+
+    def _touch(self, key, params=None):
+        index = self._read_index()
+        entry = index.get(key) or {'params': params, 'size': _directory_size(self.path(key)), 'created_at': pd.Timestamp.now().isoformat()}
+        entry['params'] = entry['params'] or params
+        # Keys are derived from the current versions, so a touched entry is current.
+        entry['versions'] = [SCENARIO_VERSION, SCHEMA_VERSION]
+        entry['last_used'] = pd.Timestamp.now().isoformat()
+        index[key] = entry
+        self._write_index(index)
+
+    def get(self, key, params=None):
+        """Returns the artifact path of a cached scenario, or None."""
+        with self._lock:
+            if not artifact_exists(self.path(key)):
+                return None
+            self._touch(key, params)
+            return self.path(key)
+
+    def get_or_compute(self, params, compute=expand_scenario):
+        """
+        Returns the artifact path of a scenario, computing it on a miss.
+
+        Parameters:
+        params (dict): Scenario parameters, as returned by scenario_params.
+        compute (callable): Function receiving (path, params) and writing the artifact at path.
+
+        Returns:
+        str: Path of the expanded artifact.
+        """
+        input_files = scenario_inputs(params)
+        prefetch_data_files(input_files)
+        key = self.key(params, input_files)
+        path = self.get(key, params)
+        if path is not None:
+            return path
+
+        tmp_path = f'{self.path(key)}.tmp-{os.getpid()}-{threading.get_ident()}'
+        try:
+            with stage('scenario.compute'):
+                compute(tmp_path, params)
+            with self._lock:
+                if artifact_exists(self.path(key)):
+                    shutil.rmtree(tmp_path)
+                else:
+                    if os.path.exists(self.path(key)):
+                        shutil.rmtree(self.path(key))
+                    os.rename(tmp_path, self.path(key))
+                self._touch(key, params)
+                self.evict(keep=key)
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        return self.path(key)
+
+    def pin(self, keys):
+        """Pins exactly the given scenarios, which are then never evicted, and unpins the rest."""
+        keys = set(keys)
+        with self._lock:
+            index = self._read_index()
+            for key, entry in index.items():
+                entry['pinned'] = key in keys
+            self._write_index(index)
+
+    def evict(self, keep=None):
+        """Deletes scenarios of other versions, then least recently used, unpinned ones until the cache fits in max_bytes."""
+        with self._lock:
+            index = self._read_index()
+            for key in [key for key, entry in index.items() if entry.get('versions') != [SCENARIO_VERSION, SCHEMA_VERSION] and key != keep]:
+                shutil.rmtree(self.path(key), ignore_errors=True)
+                del index[key]
+            total = sum(entry['size'] for entry in index.values())
+            for key in sorted(index, key=lambda key: index[key]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                if key == keep or index[key].get('pinned'):
+                    continue
+                shutil.rmtree(self.path(key), ignore_errors=True)
+                total -= index.pop(key)['size']
+            self._write_index(index)
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root, exist_ok=True)
+
+    def entries(self):
+        """Returns a DataFrame with the key, parameters, size and last use of every cached scenario."""
+        with self._lock:
+            index = self._read_index()
+        rows = [{'key': key, **(entry['params'] or {}), 'size': entry['size'], 'created_at': entry['created_at'], 'last_used': entry['last_used'], 'pinned': entry.get('pinned', False)} for key, entry in index.items()]
+        return pd.DataFrame(rows)
+
+    def warm(self, scenarios):
+        """
+        Computes every scenario that is not cached yet.
+
+        Parameters:
+        scenarios (list): Dicts of keyword arguments for scenario_params.
+
+        Returns:
+        list: Artifact paths, in the order of scenarios.
+        """
+        return [self.get_or_compute(scenario_params(**scenario)) for scenario in scenarios]
+
+
+_default_cache = None
+
+
+def default_cache():
+    """The process-wide scenario cache in the data directory."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ScenarioCache()
+    return _default_cache
+
+
+def scenario_artifact(protocol, collateral=0.4, compounded=False, tx_adm_circulana=None, cache=None):
+    """
+    Returns the expanded artifact of a scenario, from the scenario cache or computed on a miss.
+
+    Parameters:
+    protocol (str): 'aave', 'compound', 'uniswap' or 'balancer'.
+    collateral (float): Fraction of the contemplated good deposited as collateral.
+    compounded (bool): Whether returns are reinvested.
+    tx_adm_circulana (float): Circulana administration fee. Defaults to the first quota's fee.
+    cache (ScenarioCache): Cache to use (default: default_cache()).
+
+    Returns:
+    str: Path of the expanded artifact, to be read with artifacts.read_expanded.
+    """
+    cache = cache or default_cache()
+    return cache.get_or_compute(scenario_params(protocol, collateral, compounded, tx_adm_circulana))
@@ -0,0 +1,153 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from data_cache import data_path, resolve_data_file
+from instrumentation import stage
+from load_functions import GRUPO_DTYPES, grupo_usecols, latest_snapshots, preprocess_grupo_rows
+
+SNAPSHOT_DIR = 'snapshots'
+LATEST_FILE = 'latest.parquet'
+# Bump whenever the stored table changes layout, so old stores are rebuilt from scratch.
+SNAPSHOT_STORE_VERSION = 2
+
+
+def read_grupo_rows_after(filepath, watermark=None):
+    """
+    Reads the rows of a group CSV whose data_info is at or after watermark.
+
+    The CSV is parsed by Arrow in blocks and each block is filtered on data_info as it is
+    read, so only the rows from the watermark on are held, converted to pandas, renamed,
+    typed and deduplicated. Rows at the watermark itself are kept: a later export may have
+    more rows with that data_info (see SnapshotStore.apply for the ones already stored).
+
+    Parameters:
+    filepath (str): Group CSV (an export of the whole history or only of the new rows).
+    watermark (pd.Timestamp): Last data_info already ingested; None reads every row.
+
+    Returns:
+    pd.DataFrame: Rows as returned by load_functions.preprocess_grupo_rows.
+    """
+    usecols = grupo_usecols(filepath)
+    column_types = {col: pa.from_numpy_dtype(np.dtype(col_dtype)) for col, col_dtype in GRUPO_DTYPES.items() if col in usecols}
+    column_types['data_info'] = pa.timestamp('ns')
+    reader = pacsv.open_csv(filepath, convert_options=pacsv.ConvertOptions(include_columns=usecols, column_types=column_types))
+    threshold = None if watermark is None else pa.scalar(pd.Timestamp(watermark), type=pa.timestamp('ns'))
+    batches = [batch if threshold is None else batch.filter(pc.greater_equal(batch['data_info'], threshold)) for batch in reader]
+    return preprocess_grupo_rows(pa.Table.from_batches(batches, schema=reader.schema).to_pandas())
+
+
+class SnapshotStore:
+    """
+    Latest snapshot of every quota, updated incrementally from new Santander exports.
+
+    The table (one row per id, sorted by id, like load_and_preprocess_grupo) and the
+    watermark, the most recent data_info ingested, are kept in root/latest.parquet. Ingesting
+    an export only processes its rows from the watermark on that are not stored yet, and
+    reports the ids whose row changed, so the expansion can be redone for those quotas only (see
+    cotas_processor.reexpandir_cotas).
+    """
+
+    def __init__(self, root=None):
+        self.root = root or data_path(SNAPSHOT_DIR)
+        self.path = os.path.join(self.root, LATEST_FILE)
+        self.latest = None
+        self.watermark = None
+        self.sources = []
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        table = pq.read_table(self.path)
+        metadata = json.loads(table.schema.metadata[b'snapshot_store'])
+        if metadata['version'] != SNAPSHOT_STORE_VERSION:
+            return
+        self.latest = table.to_pandas()
+        self.watermark = pd.Timestamp(metadata['watermark'])
+        self.sources = metadata['sources']
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        metadata = {'version': SNAPSHOT_STORE_VERSION, 'watermark': self.watermark.isoformat(), 'sources': self.sources}
+        table = pa.Table.from_pandas(self.latest, preserve_index=False)
+        table = table.replace_schema_metadata({**table.schema.metadata, b'snapshot_store': json.dumps(metadata).encode()})
+        tmp_path = f'{self.path}.tmp-{os.getpid()}'
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def ingest(self, filepath):
+        """
+        Ingests the rows of a group CSV not stored yet and saves the store.
+
+        Parameters:
+        filepath (str): Group CSV.
+
+        Returns:
+        np.ndarray: Sorted ids that are new or whose latest row changed.
+        """
+        filepath = resolve_data_file(filepath)
+        with stage('snapshot.ingest') as timed:
+            rows = self.unseen(read_grupo_rows_after(filepath, self.watermark))
+            timed.rows = len(rows)
+            changed_ids = self.apply(rows)
+        if len(rows):
+            self.sources.append({'file': os.path.basename(filepath), 'rows': len(rows), 'changed': len(changed_ids), 'ingested_at': pd.Timestamp.now().isoformat()})
+            self.save()
+        return changed_ids
+
+    def unseen(self, rows):
+        """Rows whose (id, data_info) is not the stored snapshot of that id, e.g. rows at the watermark ingested before."""
+        if self.latest is None or rows.empty:
+            return rows
+        stored = self.latest[['id', 'data_info']].rename(columns={'data_info': 'stored_data_info'})
+        stored_data_info = rows[['id']].merge(stored, on='id', how='left')['stored_data_info'].to_numpy()
+        return rows[rows['data_info'].to_numpy() != stored_data_info]
+
+    def apply(self, rows):
+        """
+        Merges snapshot rows from the watermark on into the latest table, in place.
+
+        Rows already stored, with the same id and data_info, are skipped (see unseen).
+
+        An id counts as changed when it is new or when any column other than data_info
+        differs from its stored row; a newer snapshot with the same values only moves
+        data_info forward.
+
+        Parameters:
+        rows (pd.DataFrame): Rows as returned by read_grupo_rows_after.
+
+        Returns:
+        np.ndarray: Sorted ids that are new or whose latest row changed.
+        """
+        rows = self.unseen(rows)
+        if rows.empty:
+            return np.array([], dtype=np.int64)
+        delta = latest_snapshots(rows).reset_index(drop=True)
+        self.watermark = max(self.watermark, delta['data_info'].max()) if self.watermark is not None else delta['data_info'].max()
+        if self.latest is None:
+            self.latest = delta
+            return delta['id'].to_numpy()
+
+        delta = delta[self.latest.columns]
+        stored_ids = self.latest['id'].to_numpy()
+        delta_ids = delta['id'].to_numpy()
+        positions = np.minimum(np.searchsorted(stored_ids, delta_ids), max(len(stored_ids) - 1, 0))
+        found = (stored_ids[positions] == delta_ids) if len(stored_ids) else np.zeros(len(delta_ids), dtype=bool)
+
+        # Rows of known ids are overwritten in place; only the values are compared.
+        stored = self.latest.iloc[positions[found]].reset_index(drop=True)
+        updated = delta[found].reset_index(drop=True)
+        same = (stored == updated) | (stored.isna() & updated.isna())
+        differs = ~same.drop(columns='data_info').all(axis=1).to_numpy()
+        for column_index, column in enumerate(self.latest.columns):
+            self.latest.iloc[positions[found], column_index] = updated[column].to_numpy()
+
+        new_rows = delta[~found]
+        if len(new_rows):
+            self.latest = pd.concat([self.latest, new_rows], ignore_index=True).sort_values('id', kind='stable', ignore_index=True)
+        return np.sort(np.concatenate([delta_ids[found][differs], new_rows['id'].to_numpy()]))